@@ -0,0 +1,101 @@
+from web import autocomplete
+
+
+def _index(monkeypatch, printings):
+	keys = sorted(k for name in printings for k in autocomplete._index_keys(name))
+	monkeypatch.setattr(autocomplete, '_keys', keys)
+	monkeypatch.setattr(autocomplete, '_printings', printings)
+	monkeypatch.setattr(autocomplete, '_refresh', lambda: None)
+
+
+def test_normalize():
+	assert(autocomplete.normalize('  Æther   Vial ') == 'aether vial')
+	assert(autocomplete.normalize('Lim-Dûl') == 'lim-dul')
+
+
+def test_complete_ranking(monkeypatch):
+	_index(monkeypatch, {
+		'Lightning Bolt': [1, 2],
+		'Bolt Bend': [3],
+		'Bolt': [4],
+		'Opt': [5],
+	})
+	assert(autocomplete.complete('bolt') == [4, 3, 1, 2])
+	assert(autocomplete.complete('light') == [1, 2])
+	assert(autocomplete.complete('  ') == [])
+	assert(autocomplete.complete('bolt', limit=2) == [4, 3])
+
+
+class _Redis:
+	def __init__(self):
+		self.values = {}
+		self.lists = {}
+		self.results = None
+
+	def pipeline(self):
+		self.results = []
+		return self
+
+	def execute(self):
+		results, self.results = self.results, None
+		return results
+
+	def _result(self, value):
+		if self.results is None:
+			return value
+		self.results.append(value)
+		return self
+
+	def get(self, key):
+		value = self.values.get(key)
+		return self._result(None if value is None else str(value).encode())
+
+	def incr(self, key):
+		self.values[key] = self.values.get(key, 0) + 1
+		return self._result(self.values[key])
+
+	def rpush(self, key, value):
+		self.lists.setdefault(key, []).append(value.encode())
+		return self._result(len(self.lists[key]))
+
+	def lrange(self, key, start, end):
+		items = self.lists.get(key, [])
+		return self._result(items[len(items) + start:] if start < 0 else items)
+
+	def ltrim(self, key, start, end):
+		self.lists[key] = self.lists.get(key, [])[start:]
+		return self._result(True)
+
+
+def _database(monkeypatch, printings):
+	redis = _Redis()
+	monkeypatch.setattr(autocomplete.functions, 'get_redis', lambda: redis)
+	monkeypatch.setattr(
+		autocomplete, 'fetch_query',
+		lambda qry: [{'name': k, 'printings': v} for k, v in printings.items()]
+	)
+	monkeypatch.setattr(autocomplete, '_version', None)
+	monkeypatch.setattr(autocomplete, '_rebuilding', False)
+	autocomplete.warm()
+	return redis
+
+
+def test_add_merges_published_deltas(monkeypatch):
+	_database(monkeypatch, {'Opt': [5]})
+	autocomplete.add({'Shock': [7]})
+	autocomplete.add({'Opt': [8], 'Shocker': [9]})
+	assert(autocomplete.complete('shock') == [7, 9])
+	assert(autocomplete.complete('opt') == [8, 5])
+	assert(autocomplete._version == 2)
+
+
+def test_rebuild_when_deltas_trimmed(monkeypatch):
+	_database(monkeypatch, {'Opt': [5]})
+	rebuilds = []
+	monkeypatch.setattr(autocomplete, '_rebuild', lambda: rebuilds.append(1))
+	monkeypatch.setattr(autocomplete, 'DELTAS_KEPT', 1)
+	autocomplete.add({'Shock': [7]})
+	autocomplete.add({'Bolt': [8]})
+	# The old index is still served while the rebuild runs
+	assert(autocomplete.complete('opt') == [5])
+	assert(rebuilds == [1])
@@ -0,0 +1,82 @@
+from web import catalogue, records
+
+
+def _card(name, scryfallid, code, collectornumber):
+	return records.Card(
+		name=name,
+		scryfallid=scryfallid,
+		rarity='C',
+		set=code,
+		set_name=code.upper(),
+		collectornumber=collectornumber,
+		multifaced=False,
+		cmc=1,
+		typeline='Instant',
+		language='en'
+	)
+
+
+CARDS = [
+	_card('Opt', 'a1', 'xln', '65'),
+	_card('Lightning Bolt', 'b2', 'm10', '146'),
+	_card('Opt', 'c3', 'dom', '60'),
+	_card('Optimus', 'd4', 'xln', '66'),
+	_card('Shock', 'e5', 'm19', '156'),
+]
+
+
+def _build(monkeypatch, tmp_path, cards=CARDS):
+	filename = str(tmp_path / 'catalogue.dat')
+	monkeypatch.setattr(catalogue, 'CATALOGUE_FILE', filename)
+	monkeypatch.setattr(catalogue, '_opened', None)
+	assert(catalogue.build(cards, filename) == len(cards))
+	return filename
+
+
+def test_get(monkeypatch, tmp_path):
+	_build(monkeypatch, tmp_path)
+	assert(catalogue.get('m10', '146') == CARDS[1])
+	assert(catalogue.get('M19', '156') == CARDS[4])
+	assert(catalogue.get('m10', '147') is None)
+	assert(catalogue.get('m10', '1460000000000') is None)
+
+
+def test_get_bulk(monkeypatch, tmp_path):
+	_build(monkeypatch, tmp_path)
+	found, missing = catalogue.get_bulk(['e5', 'zz', 'a1', 'a', 'e'])
+	assert(found == [CARDS[4], CARDS[0]])
+	assert(missing == ['zz', 'a', 'e'])
+
+
+def test_find_every_key(monkeypatch, tmp_path):
+	cards = [
+		_card('Card {}'.format(n), 'id{}'.format(n * 7 % 101), 'set', str(n))
+		for n in range(101)
+	]
+	_build(monkeypatch, tmp_path, cards)
+	found, missing = catalogue.get_bulk([c.scryfallid for c in cards])
+	assert(found == cards)
+	assert(missing == [])
+
+
+def test_search(monkeypatch, tmp_path):
+	_build(monkeypatch, tmp_path)
+	# An exact name gets all of its printings and nothing else
+	assert(catalogue.search(' OPT ') == [CARDS[0], CARDS[2]])
+	assert(catalogue.search('opti') == [CARDS[3]])
+	assert(catalogue.search('lightning  bolt') == [CARDS[1]])
+	assert(catalogue.search('op', limit=2) == [CARDS[0], CARDS[2]])
+	assert(catalogue.search('bolt') == [])
+	assert(catalogue.search('') == [])
+
+
+def test_missing_or_old_file(monkeypatch, tmp_path):
+	filename = str(tmp_path / 'catalogue.dat')
+	monkeypatch.setattr(catalogue, 'CATALOGUE_FILE', filename)
+	monkeypatch.setattr(catalogue, '_opened', None)
+	assert(catalogue.get('m10', '146') is None)
+
+	with open(filename, 'wb') as f:
+		f.write(b'{}\n' + bytes(48) + b'MTGCAT02')
+	assert(catalogue.get_bulk(['a1']) == ([], ['a1']))
+	assert(catalogue.search('opt') == [])
@@ -0,0 +1,45 @@
+import base64
+import datetime
+import json
+
+from web import collection
+
+
+def test_cursor_round_trip():
+	cursor = collection.encode_cursor(
+		['setname', 'DESC'], datetime.date(2020, 1, 2), ['M21', '12a', 7]
+	)
+	assert(collection.decode_cursor(cursor) == {
+		'sort': ['setname', 'DESC'],
+		'key': '2020-01-02',
+		'after': ['M21', '12a', 7]
+	})
+
+
+def test_cursor_null_key():
+	cursor = collection.encode_cursor(['price', 'ASC'], None, ['M21', '1', 3])
+	assert(collection.decode_cursor(cursor)['key'] is None)
+
+
+def _encode(data):
+	data = json.dumps(data).encode('utf-8')
+	return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def test_decode_cursor_rejects_bad_input():
+	good = {'sort': ['name', 'ASC'], 'key': 'Opt', 'after': ['M21', '1', 3]}
+	assert(collection.decode_cursor(_encode(good)) is not None)
+	for bad in (
+		None,
+		'',
+		'not base64!',
+		_encode([1, 2, 3]),
+		_encode({k: v for k, v in good.items() if k != 'sort'}),
+		_encode({k: v for k, v in good.items() if k != 'after'}),
+		_encode(dict(good, sort='name')),
+		_encode(dict(good, key={'a': 1})),
+		_encode(dict(good, after='M21')),
+		_encode(dict(good, after=['M21', '1'])),
+		_encode(dict(good, after=['M21', '1', '3'])),
+	):
+		assert(collection.decode_cursor(bad) is None)
@@ -0,0 +1,33 @@
+import os
+
+from web import diskcache
+
+
+def test_store_and_load(monkeypatch, tmp_path):
+	monkeypatch.setattr(diskcache, 'CACHE_DIR', str(tmp_path))
+	cachekey = diskcache.key('/sets/m21', None)
+	assert(diskcache.load(cachekey) is None)
+	diskcache.store(cachekey, {'stored': 1, 'body': {'code': 'm21'}})
+	assert(diskcache.load(cachekey) == {'stored': 1, 'body': {'code': 'm21'}})
+
+
+def test_key_ignores_param_order():
+	assert(
+		diskcache.key('/cards/search', {'q': 'opt', 'unique': 'prints'})
+		== diskcache.key('/cards/search', {'unique': 'prints', 'q': 'opt'})
+	)
+	assert(diskcache.key('/sets/m21') != diskcache.key('/sets/m20'))
+
+
+def test_evict_least_recently_used(monkeypatch, tmp_path):
+	monkeypatch.setattr(diskcache, 'CACHE_DIR', str(tmp_path))
+	monkeypatch.setattr(diskcache, 'EVICT_EVERY', 1000)
+	for n, name in enumerate(('old', 'used', 'new')):
+		diskcache.store(name, {'body': 'x' * 100})
+		os.utime(diskcache._filename(name), (n, n))
+	# A hit makes the oldest entry the most recently used
+	diskcache.load('used')
+
+	monkeypatch.setattr(diskcache, 'MAX_SIZE', 250)
+	diskcache._evict()
+	assert(sorted(os.listdir(str(tmp_path))) == ['new.json', 'used.json'])
@@ -1,7 +1,17 @@
-from web import app
+from web import app, _history_points
 
 
 def test_flask_alive():
 	test_client = app.test_client()
 	resp = test_client.get('/ping')
 	assert(resp.json == {'ping': 'pong'})
+
+
+def test_history_points():
+	assert(_history_points({}) == 90)
+	assert(_history_points({'points': '30'}) == 30)
+	assert(_history_points({'points': '1'}) == 2)
+	assert(_history_points({'points': '100000'}) == 365)
+	assert(_history_points({'points': '-5'}) is None)
+	assert(_history_points({'points': 'abc'}) is None)
+	assert(_history_points({'points': '1.5'}) is None)
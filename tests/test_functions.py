@@ -0,0 +1,47 @@
+import threading
+import time
+
+from web import functions
+
+
+def test_batched():
+	assert(list(functions.batched(range(5), 2)) == [[0, 1], [2, 3], [4]])
+	assert(list(functions.batched([], 3)) == [])
+
+
+def test_imap_bounded_keeps_order():
+	def slow_square(x):
+		time.sleep(0.01 * (5 - x))
+		return x * x
+	results = functions.imap_bounded(slow_square, range(5), 3)
+	assert(list(results) == [0, 1, 4, 9, 16])
+
+
+def test_imap_bounded_limits_in_flight():
+	lock = threading.Lock()
+	state = {'running': 0, 'peak': 0}
+
+	def work(x):
+		with lock:
+			state['running'] += 1
+			state['peak'] = max(state['peak'], state['running'])
+		time.sleep(0.01)
+		with lock:
+			state['running'] -= 1
+		return x
+
+	assert(list(functions.imap_bounded(work, range(20), 2)) == list(range(20)))
+	assert(state['peak'] <= 2)
+
+
+def test_imap_bounded_consumes_lazily():
+	pulled = []
+
+	def items():
+		for x in range(100):
+			pulled.append(x)
+			yield x
+
+	results = functions.imap_bounded(lambda x: x, items(), 2)
+	assert(next(results) == 0)
+	assert(len(pulled) <= 4)
@@ -0,0 +1,44 @@
+from web import lookup
+
+
+def _database(monkeypatch, printings):
+	queries = []
+
+	def fetch_query(qry, qargs=None):
+		queries.append(qargs)
+		ids = qargs[0] if qargs else list(printings)
+		return [{'scryfallid': k, 'id': printings[k]} for k in ids if k in printings]
+
+	monkeypatch.setattr(lookup, 'fetch_query', fetch_query)
+	monkeypatch.setattr(lookup, '_printings', {})
+	monkeypatch.setattr(lookup, '_warmed', False)
+	return queries
+
+
+def test_resolve_from_index(monkeypatch):
+	queries = _database(monkeypatch, {'a': 1, 'b': 2})
+	assert(lookup.resolve(['a', 'b']) == {'a': 1, 'b': 2})
+	assert(lookup.resolve(['b']) == {'b': 2})
+	# Warmed once, every later hit comes from memory
+	assert(len(queries) == 1)
+
+
+def test_resolve_unknown(monkeypatch):
+	queries = _database(monkeypatch, {'a': 1})
+	assert(lookup.resolve(['a', 'x', 'x']) == {'a': 1})
+	assert(queries[-1] == (['x'],))
+
+
+def test_resolve_inserted_elsewhere(monkeypatch):
+	printings = {'a': 1}
+	_database(monkeypatch, printings)
+	lookup.resolve(['a'])
+	printings['b'] = 2
+	assert(lookup.resolve(['a', 'b']) == {'a': 1, 'b': 2})
+	assert(lookup._printings == {'a': 1, 'b': 2})
+
+
+def test_add(monkeypatch):
+	_database(monkeypatch, {})
+	lookup.add({'c': 3})
+	assert(lookup.resolve(['c']) == {'c': 3})
@@ -0,0 +1,38 @@
+from web import pricing
+
+
+def _row(id, groupid, productid='p'):
+	return {'id': id, 'groupid': groupid, 'productid': productid}
+
+
+def test_apply_budget_group_mode():
+	rows = [_row(1, 10), _row(2, 10), _row(3, 20), _row(4, 30), _row(5, 10)]
+	kept = list(pricing.apply_budget(rows, True, budget=2))
+	assert([r['id'] for r in kept] == [1, 2, 3, 5])
+
+
+def test_apply_budget_product_mode():
+	rows = [_row(x, None) for x in range(600)]
+	kept = list(pricing.apply_budget(rows, False, budget=2))
+	assert(len(kept) == 500)
+
+
+def test_apply_budget_counts_listings():
+	rows = [_row(1, 10, None), _row(2, 20), _row(3, 10, None)]
+	kept = list(pricing.apply_budget(
+		rows, True, budget=3, listing_pages={10: 2}
+	))
+	# Set 10 costs its two listing pages plus the group request
+	assert([r['id'] for r in kept] == [1, 3])
+
+
+def test_apply_budget_unpriceable_is_free():
+	rows = [_row(1, None, None), _row(2, 10)]
+	kept = list(pricing.apply_budget(rows, True, budget=0))
+	assert([r['id'] for r in kept] == [1])
+
+
+def test_chunk_ids():
+	rows = [_row(x, x % 2) for x in range(5)]
+	assert(list(pricing.chunk_ids(rows, False, size=2)) == [[0, 1], [2, 3], [4]])
+	assert(list(pricing.chunk_ids(rows, True, size=2)) == [[0, 2], [4], [1, 3]])
@@ -0,0 +1,110 @@
+import io
+import os
+
+from web import scryfall
+
+
+def _parse(text, chunk_size):
+	return list(scryfall._iter_json_array(io.StringIO(text), chunk_size))
+
+
+def test_iter_json_array_objects():
+	text = '[{"id": "a", "name": "Opt"}, {"id": "b", "name": "Shock"}]'
+	for chunk_size in (1, 2, 7, 65536):
+		assert(_parse(text, chunk_size) == [
+			{'id': 'a', 'name': 'Opt'},
+			{'id': 'b', 'name': 'Shock'}
+		])
+
+
+def test_iter_json_array_scalars_across_chunks():
+	for chunk_size in (1, 2, 3, 65536):
+		assert(_parse('[123, 456]', chunk_size) == [123, 456])
+		assert(_parse('[1.5,"ab",true,null]', chunk_size) == [1.5, 'ab', True, None])
+
+
+def test_iter_json_array_empty():
+	assert(_parse(' [ ] ', 1) == [])
+
+
+def test_iter_json_array_not_array():
+	try:
+		_parse('{"id": "a"}', 4)
+	except scryfall.ScryfallException:
+		pass
+	else:
+		assert(False)
+
+
+def test_iter_json_array_truncated():
+	try:
+		_parse('[{"id": "a"}, {"id": ', 4)
+	except ValueError:
+		pass
+	else:
+		assert(False)
+
+
+class _Response:
+	def __init__(self, status_code, body=None, etag=None):
+		self.status_code = status_code
+		self.content = body
+		self.headers = {'ETag': etag} if etag else {}
+
+	def raise_for_status(self):
+		pass
+
+
+def _upstream(monkeypatch, tmp_path, responses):
+	monkeypatch.setattr(scryfall.diskcache, 'CACHE_DIR', str(tmp_path))
+	sent = []
+
+	def send(method, url, **kwargs):
+		sent.append(kwargs['headers'])
+		return responses.pop(0)
+
+	monkeypatch.setattr(scryfall.httpclient, 'send', send)
+	return sent
+
+
+def test_cached_within_ttl(monkeypatch, tmp_path):
+	sent = _upstream(monkeypatch, tmp_path, [_Response(200, b'{"code": "m21"}')])
+	assert(scryfall.get_set('m21') == {'code': 'm21'})
+	assert(scryfall.get_set('m21') == {'code': 'm21'})
+	assert(len(sent) == 1)
+
+
+def test_revalidated_after_ttl(monkeypatch, tmp_path):
+	sent = _upstream(monkeypatch, tmp_path, [
+		_Response(200, b'{"code": "m21"}', etag='"v1"'),
+		_Response(304)
+	])
+	monkeypatch.setattr(scryfall, 'CACHE_TTLS', (('/sets', 0),))
+	scryfall.get_set('m21')
+	assert(scryfall.get_set('m21') == {'code': 'm21'})
+	assert(sent[1]['If-None-Match'] == '"v1"')
+
+
+def test_search_not_cached(monkeypatch, tmp_path):
+	body = b'{"object": "list", "data": []}'
+	sent = _upstream(monkeypatch, tmp_path, [_Response(200, body)] * 2)
+	scryfall.search('t:instant')
+	scryfall.search('t:instant')
+	assert(len(sent) == 2)
+	assert(os.listdir(str(tmp_path)) == [])
+
+
+def test_search_plain_names_offline(monkeypatch, tmp_path):
+	body = b'{"object": "list", "data": []}'
+	sent = _upstream(monkeypatch, tmp_path, [_Response(200, body)] * 3)
+	monkeypatch.setattr(
+		scryfall.catalogue, 'search', lambda name: ['Opt'] if name == 'opt' else []
+	)
+	assert(scryfall.search('opt') == ['Opt'])
+	assert(len(sent) == 0)
+	# Not in the catalogue yet
+	assert(scryfall.search('brand new card') == [])
+	assert(len(sent) == 1)
+	for query in ('!opt', 't:instant', 'opt -t:land', 'cmc>2', '"opt"'):
+		assert(scryfall.SEARCH_SYNTAX.search(query))
+	assert(not scryfall.SEARCH_SYNTAX.search("Ancestor's Chosen-Fire // Ice, Jr"))
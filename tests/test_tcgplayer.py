@@ -0,0 +1,33 @@
+from web import tcgplayer
+
+
+def test_product_key():
+	assert(
+		tcgplayer._product_key('Fire // Ice', '128', 'en')
+		== ('fire', '128', 'en')
+	)
+	assert(
+		tcgplayer._product_key('Opt (Showcase)', '045/280', 'en')
+		== ('opt', '45', 'en')
+	)
+	assert(tcgplayer._product_key('Opt', 7, 'ja') == ('opt', '7', 'ja'))
+
+
+def test_match_prices():
+	def result(productid, subtype, mid, market):
+		return {
+			'productId': productid,
+			'subTypeName': subtype,
+			'midPrice': mid,
+			'marketPrice': market
+		}
+
+	results = [
+		result(1, 'Normal', 1.5, 1.0),
+		result(1, 'Foil', None, 4.0),
+		result(2, 'Normal', 0.25, 0.2),
+	]
+	prices = tcgplayer._match_prices({'10': '1', '11': '3'}, results)
+	assert(prices['10']['normal'] == 1.5)
+	assert(prices['10']['foil'] == 4.0)
+	assert(prices['11'] == {'normal': None, 'foil': None, 'type': None})
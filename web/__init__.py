@@ -11,8 +11,7 @@ import rollbar.contrib.flask
 
 # Local imports
 from web import (
-	collection, deck, scryfall, tcgplayer, config,
-	functions
+	autocomplete, collection, deck, pricing, config
 )
 from flasktools import handle_exception, params_to_dict, serve_static_file
 from flasktools.auth import is_logged_in, check_login, login_required
@@ -140,11 +139,8 @@ def collection_card() -> Response:
 			"""
 			SELECT
 				p.id, c.name, cs.name AS setname, get_rarity(p.rarity) AS rarity,
-				uc.quantity, uc.foil, get_price(uc.id) AS price, p.tcgplayer_productid,
-				COALESCE(
-					(SELECT currencycode FROM app.enduser WHERE id = uc.userid),
-					'USD'
-				) AS currencycode,
+				uc.quantity, uc.foil, {} AS price, p.tcgplayer_productid,
+				COALESCE(eu.currencycode, 'USD') AS currencycode,
 				total_printings_owned(uc.userid, p.cardid) AS printingsowned,
 				(
 					SELECT to_char(MAX(created), 'DD/MM/YY')
@@ -156,9 +152,10 @@ def collection_card() -> Response:
 			LEFT JOIN printing p ON (uc.printingid = p.id)
 			LEFT JOIN card c ON (p.cardid = c.id)
 			LEFT JOIN card_set cs ON (p.card_setid = cs.id)
+			{}
 			WHERE uc.userid = %s
 			AND uc.id = %s
-			""",
+			""".format(collection.PRICE, collection.RATE_JOIN),
 			(session['userid'], params['user_cardid'],),
 			single_row=True
 		)
@@ -215,43 +212,37 @@ def collection_card_pricehistory() -> Response:
 	params = params_to_dict(request.args)
 	resp = {}
 
+	points = _history_points(params)
+	if points is None:
+		return jsonify(error='Invalid number of points.')
+
 	printingid = None
-	if params.get('user_cardid'):
-		printingid = fetch_query(
-			"SELECT printingid FROM user_card WHERE id = %s",
-			(params['user_cardid'],),
+	if str(params.get('user_cardid') or '').isdigit():
+		card = fetch_query(
+			"SELECT printingid FROM user_card WHERE id = %s AND userid = %s",
+			(params['user_cardid'], session['userid'],),
 			single_row=True
-		)['printingid']
+		)
+		if card:
+			printingid = card['printingid']
 
 	if printingid is not None:
-		history = fetch_query(
-			"""
-			SELECT
-				convert_price(ph.price, %s)::NUMERIC AS price,
-				convert_price(ph.foilprice, %s)::NUMERIC AS foilprice,
-				to_char(d.day, 'DD/MM/YY') AS created
-			FROM generate_series(
-				(SELECT MIN(created) FROM price_history WHERE printingid = %s),
-				(SELECT MAX(created) FROM price_history WHERE printingid = %s),
-				'1 day'::INTERVAL
-			) d(day)
-			LEFT JOIN price_history ph ON (ph.created = d.day AND ph.printingid = %s)
-			""",
-			(session['userid'], session['userid'], printingid, printingid, printingid,)
-		)
+		history = pricing.get_history([printingid], points)
+		rate = collection.get_exchange_rate()
+		series = history['prices'][str(printingid)]
 
-		resp['dates'] = [h['created'] for h in history]
+		resp['dates'] = history['dates']
 		prices = {
 			'label': 'Price',
 			'backgroundColor': 'rgba(40, 181, 246, 0.2)',
 			'borderColor': 'rgba(40, 181, 246, 1)',
-			'data': [functions.make_float(h['price']) for h in history]
+			'data': _convert_prices(series['price'], rate)
 		}
 		foilprices = {
 			'label': 'Foil Price',
 			'backgroundColor': 'rgba(175, 90, 144, 0.2)',
 			'borderColor': 'rgba(175, 90, 144, 1)',
-			'data': [functions.make_float(h['foilprice']) for h in history]
+			'data': _convert_prices(series['foilprice'], rate)
 		}
 
 		resp['datasets'] = []
@@ -265,6 +256,57 @@ def collection_card_pricehistory() -> Response:
 	return jsonify(**resp)
 
 
+@app.route('/collection/pricehistory', methods=['GET'])
+@login_required
+def collection_pricehistory() -> Response:
+	params = params_to_dict(request.args)
+	points = _history_points(params)
+	if points is None:
+		return jsonify(error='Invalid number of points.')
+
+	user_cardids = [
+		x.strip() for x in str(params.get('user_cardids') or '').split(',')
+	]
+	if not all(x.isdigit() for x in user_cardids):
+		return jsonify(error='No cards selected.')
+	user_cardids = [int(x) for x in user_cardids]
+
+	cards = fetch_query(
+		"""
+		SELECT uc.id AS user_cardid, uc.printingid, c.name
+		FROM user_card uc
+		LEFT JOIN printing p ON (p.id = uc.printingid)
+		LEFT JOIN card c ON (c.id = p.cardid)
+		WHERE uc.userid = %s
+		AND uc.id = ANY(%s)
+		""",
+		(session['userid'], user_cardids,)
+	)
+	if not cards:
+		return jsonify(error='No cards selected.')
+
+	history = pricing.get_history([c['printingid'] for c in cards], points)
+	rate = collection.get_exchange_rate()
+	for c in cards:
+		series = history['prices'][str(c['printingid'])]
+		c['price'] = _convert_prices(series['price'], rate)
+		c['foilprice'] = _convert_prices(series['foilprice'], rate)
+
+	return jsonify(dates=history['dates'], cards=cards)
+
+
+def _history_points(params: dict) -> int:
+	# Resolution of a price history chart, None if it isn't a number
+	points = str(params.get('points') or 90)
+	if not points.isdigit():
+		return None
+	return min(max(int(points), 2), 365)
+
+
+def _convert_prices(prices: list, rate: float) -> list:
+	return [round(p * rate, 2) if p is not None else None for p in prices]
+
+
 @app.route('/collection/card/add', methods=['POST'])
 @login_required
 def collection_card_add() -> Response:
@@ -350,21 +392,41 @@ def search() -> Response:
 	results = []
 
 	if params.get('query'):
-		search = '%' + params['query'] + '%'
-		results = fetch_query(
-			"""
-			SELECT
-				p.id, c.name, s.code, s.name AS setname, s.code AS setcode,
-				CASE WHEN p.language != 'en' THEN UPPER(p.language) END AS language,
-				p.collectornumber
-			FROM printing p
-			LEFT JOIN card c ON (p.cardid = c.id)
-			LEFT JOIN card_set s ON (p.card_setid = s.id)
-			WHERE c.name ILIKE %s
-			ORDER BY c.name ASC, s.released DESC LIMIT 50
-			""",
-			(search,)
-		)
+		printingids = autocomplete.complete(params['query'], 50)
+		if not printingids:
+			# Nothing imported starts with the query, try the offline catalogue
+			printingids = collection.import_from_catalogue(params['query'], 50)
+		if printingids:
+			results = fetch_query(
+				"""
+				SELECT
+					p.id, c.name, s.code, s.name AS setname, s.code AS setcode,
+					CASE WHEN p.language != 'en' THEN UPPER(p.language) END AS language,
+					p.collectornumber
+				FROM printing p
+				LEFT JOIN card c ON (p.cardid = c.id)
+				LEFT JOIN card_set s ON (p.card_setid = s.id)
+				WHERE p.id = ANY(%s)
+				ORDER BY array_position(%s, p.id)
+				""",
+				(printingids, printingids,)
+			)
+		else:
+			# No name starts with the query, fall back to substring matching
+			results = fetch_query(
+				"""
+				SELECT
+					p.id, c.name, s.code, s.name AS setname, s.code AS setcode,
+					CASE WHEN p.language != 'en' THEN UPPER(p.language) END AS language,
+					p.collectornumber
+				FROM search_cards(%s) c
+				JOIN printing p ON (p.cardid = c.cardid)
+				LEFT JOIN card_set s ON (p.card_setid = s.id)
+				ORDER BY c.rank, c.similarity DESC, c.name ASC, s.released DESC
+				LIMIT 50
+				""",
+				(params['query'],)
+			)
 		for r in results:
 			if not os.path.exists(asynchro.card_image_filename(r['id'])):
 				asynchro.get_card_image.delay(r['id'], r['setcode'], r['collectornumber'])
@@ -376,89 +438,60 @@ def search() -> Response:
 @app.route('/csv_upload', methods=['POST'])
 @login_required
 def csv_upload() -> Response:
-	import csv
+	import hashlib
+	import io
 
-	upload = request.files['upload']
-	filename = '/tmp/upload_{}_{}.csv'.format(os.urandom(32), session['userid'])
-	try:
-		upload.save(filename)
-	except FileNotFoundError:
-		return jsonify(error='Error uploading file. Please try again.')
-	rows = []
-	scryfall_ids = []
-	with open(filename) as csvfile:
-		importreader = csv.DictReader(csvfile)
-		for row in importreader:
-			rows.append({
-				'scryfallid': row['Scryfall ID'],
-				'foil': int(row['Foil quantity']) > 0,
-				'quantity': row['Quantity']
-			})
-			scryfall_ids.append(row['Scryfall ID'])
-	os.remove(filename)
+	content = request.files['upload'].read()
+	contenthash = hashlib.sha256(content).hexdigest()
 
-	new = []
-	for scryfallid in scryfall_ids:
-		qry = "SELECT 1 FROM printing WHERE scryfallid = %s::TEXT"
-		qargs = (scryfallid,)
-		if len(fetch_query(qry, qargs)) == 0:
-			new.append(scryfallid)
+	existing = collection.find_import(contenthash)
+	if existing and existing['finished'] and existing['failed']:
+		# Give the rows that failed last time another go
+		collection.retry_import(existing['id'])
+		asynchro.run_import.delay(existing['id'])
+		return jsonify(importid=existing['id'], retried=True)
+	if existing:
+		return jsonify(importid=existing['id'], duplicate=True)
 
-	bulk_lots = ([new[i:i + 75] for i in range(0, len(new), 75)])
-	for lot in bulk_lots:
-		resp = scryfall.get_bulk(lot)
-		collection.import_cards(resp)
+	try:
+		rows = collection.parse_csv(io.BytesIO(content))
+	except (KeyError, ValueError, UnicodeDecodeError):
+		return jsonify(error='Error reading file. Please check the CSV format.')
+
+	importid = collection.create_import(
+		request.files['upload'].filename,
+		contenthash,
+		rows
+	)
+	asynchro.run_import.delay(importid)
+
+	return jsonify(importid=importid)
 
-	importid = mutate_query(
-		"""
-		INSERT INTO import (filename, userid)
-		VALUES (%s, %s)
-		RETURNING id
-		""",
-		(upload.filename, session['userid'],),
-		returning=True
-	)['id']
-
-	for row in rows:
-		row['printingid'] = fetch_query(
-			"SELECT id FROM printing WHERE scryfallid = %s::TEXT",
-			(row['scryfallid'],),
-			single_row=True
-		)['id']
-		# Doing this in loop instead of executemany due to needing RETURNING
-		row['import_rowid'] = mutate_query(
-			"""
-			INSERT INTO import_row (importid, printingid, foil, quantity)
-			VALUES (%s, %s, %s, %s)
-			RETURNING id
-			""",
-			(importid, row['printingid'], row['foil'], row['quantity'],),
-			returning=True
-		)['id']
 
-	complete_import(importid)
+@app.route('/imports/<int:importid>/progress', methods=['GET'])
+@login_required
+def import_progress(importid: int) -> Response:
+	progress = collection.get_import_progress(importid)
+	if progress is None:
+		return jsonify(error='No import found.')
 
-	return jsonify(new)
+	return jsonify(**progress)
 
 
-def complete_import(importid: int) -> None:
-	rows = fetch_query(
-		"SELECT * FROM import_row WHERE NOT complete AND importid = %s",
-		(importid,)
-	)
-	for row in rows:
-		collection.add(row['printingid'], row['foil'], row['quantity'])
-		# Mark import for this card as completed
-		mutate_query(
-			"UPDATE import_row SET complete = true WHERE id = %s",
-			(row['id'],)
-		)
+@app.route('/imports/resume', methods=['POST'])
+def resume_imports() -> Response:
+	asynchro.resume_imports.delay()
+	return jsonify()
 
 
 @app.route('/update_prices', methods=['GET'])
 @app.route('/update_prices/<int:printingid>', methods=['GET'])
 def update_prices(printingid: int = None) -> Response:
-	_update_prices(printingid=printingid)
+	params = params_to_dict(request.args)
+	# Whole-catalogue refreshes price a set per request by default
+	default_mode = 'group' if printingid is None else 'product'
+	group_mode = params.get('mode', default_mode) == 'group'
+	_update_prices(printingid=printingid, group_mode=group_mode)
 
 	return jsonify()
 
@@ -470,28 +503,22 @@ def update_missing_prices() -> Response:
 	return jsonify()
 
 
-def _update_prices(printingid=None, missing_prices=False):
-	qry = """SELECT p.id, p.collectornumber, c.name, p.rarity,
-				s.code AS set_code, s.name AS set_name, s.tcgplayer_groupid AS groupid,
-				p.tcgplayer_productid AS productid
-			FROM printing p
-			LEFT JOIN card_set s ON (s.id = p.card_setid)
-			LEFT JOIN card c ON (c.id = p.cardid)
-			WHERE NOT is_basic_land(c.id)"""
-	qargs = ()
-	if printingid is not None:
-		qry += " AND p.id = %s"
-		qargs += (printingid,)
-	if missing_prices:
-		qry += " AND COALESCE(p.price, p.foilprice) IS NULL"
-	qry += """ ORDER BY
-		EXISTS(SELECT 1 FROM user_card WHERE printingid=c.id) DESC,
-		c.name ASC"""
-	cards = fetch_query(qry, qargs)
+def _update_prices(
+	printingid: int = None,
+	missing_prices: bool = False,
+	group_mode: bool = False
+) -> None:
+	asynchro.refresh_prices.delay(
+		printingid=printingid,
+		missing_prices=missing_prices,
+		group_mode=group_mode
+	)
 
-	tcgplayer_token = tcgplayer.login()
 
-	asynchro.fetch_prices.delay(cards, tcgplayer_token)
+@app.route('/compact_price_history', methods=['POST'])
+def compact_price_history() -> Response:
+	asynchro.compact_price_history.delay()
+	return jsonify()
 
 
 @app.route('/update_rates', methods=['POST'])
@@ -500,6 +527,12 @@ def update_rates() -> Response:
 	return jsonify()
 
 
+@app.route('/catalogue/rebuild', methods=['POST'])
+def rebuild_catalogue() -> Response:
+	asynchro.build_catalogue.delay()
+	return jsonify()
+
+
 @app.route('/refresh', methods=['POST'])
 @login_required
 def refresh() -> Response:
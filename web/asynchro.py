@@ -1,19 +1,32 @@
 # Standard library imports
+import json
 import os
+import time
 
 # Local imports
 from web import (
-	app, scryfall, tcgplayer, openexchangerates, collection,
-	config
+	app, scryfall, tcgplayer, openexchangerates, collection, catalogue,
+	pricing, functions, config
 )
 from flasktools import get_static_file, fetch_image
 from flasktools.celery import setup_celery
-from flasktools.db import mutate_query
+from flasktools.db import fetch_query, mutate_query
 import rollbar
+from celery import group
 from celery.signals import task_failure
 
 celery = setup_celery(app)
 
+PRICE_WORKERS = getattr(config, 'PRICE_WORKERS', 4)
+# Chunk tasks tally into this hash, the last one to finish reports the run
+PRICE_RUN_KEY = 'collector:pricerefresh:{}'
+PRICE_RUN_TTL = 60 * 60 * 24
+PRICE_HISTORY_COMPACT_AFTER = getattr(
+	config, 'PRICE_HISTORY_COMPACT_AFTER', '1 year'
+)
+PRICE_HISTORY_ROLLUP = getattr(config, 'PRICE_HISTORY_ROLLUP', 'week')
+IMPORT_ATTEMPTS = getattr(config, 'IMPORT_ATTEMPTS', 3)
+
 
 @task_failure.connect
 def handle_task_failure(**kwargs):
@@ -55,7 +68,7 @@ def card_art_filename(cardid: int) -> str:
 def get_card_art(cardid: int, code: str, collectornumber: str) -> None:
 	filename = card_art_filename(cardid)
 	if not os.path.exists(filename):
-		url = scryfall.get(code, collectornumber)['arturl']
+		url = scryfall.get(code, collectornumber).arturl
 		fetch_image(filename, url)
 
 
@@ -68,43 +81,167 @@ def get_card_image(cardid: int, code: str, collectornumber: str) -> None:
 	filename = card_image_filename(cardid)
 	if not os.path.exists(filename):
 		try:
-			url = scryfall.get(code, collectornumber)['imageurl']
+			url = scryfall.get(code, collectornumber).imageurl
 			fetch_image(filename, url)
 		except scryfall.NotFound:
 			pass
 
 
 @celery.task(queue='collector')
-def fetch_prices(cards: list, tcgplayer_token: str) -> None:
+def refresh_prices(
+	printingid: int = None,
+	missing_prices: bool = False,
+	group_mode: bool = False
+) -> None:
+	# Coordinator: streams due ids and fans them out as small id-only chunks
+	# so the refresh scales with workers instead of one long task
+	started = time.time()
+	scheduled = printingid is None and not missing_prices
+	rows = pricing.iter_due(
+		printingid=printingid,
+		missing_prices=missing_prices,
+		scheduled=scheduled
+	)
+	if scheduled:
+		rows = pricing.apply_budget(
+			rows, group_mode, listing_pages=pricing.get_listing_pages()
+		)
+	chunks = list(pricing.chunk_ids(rows, group_mode))
+	if not chunks:
+		print('No prices due for refresh.')
+		return
+
+	# No result backend is needed, progress is counted in Redis instead
+	run = PRICE_RUN_KEY.format(refresh_prices.request.id or started)
+	redis = functions.get_redis()
+	redis.hmset(run, {'chunks': len(chunks), 'started': started})
+	redis.expire(run, PRICE_RUN_TTL)
+
+	print('Dispatching {} price chunks.'.format(len(chunks)))
+	group(
+		fetch_price_chunk.s(ids, group_mode=group_mode, run=run)
+		for ids in chunks
+	).apply_async()
+
+
+@celery.task(queue='collector')
+def fetch_price_chunk(
+	ids: list,
+	group_mode: bool = False,
+	run: str = None
+) -> None:
+	stats = {}
+	try:
+		stats = fetch_prices(pricing.get_printings(ids), group_mode=group_mode)
+	except Exception:
+		stats = {'failed': 1}
+		raise
+	finally:
+		if run is not None:
+			_count_price_chunk(run, stats)
+
+
+def _count_price_chunk(run: str, stats: dict) -> None:
+	redis = functions.get_redis()
+	pipe = redis.pipeline()
+	for key in ('printings', 'lots', 'rows', 'failed'):
+		pipe.hincrby(run, key, stats.get(key, 0))
+	pipe.hincrby(run, 'done', 1)
+	done = pipe.execute()[-1]
+
+	totals = {
+		k.decode('utf-8'): float(v) for k, v in redis.hgetall(run).items()
+	}
+	if done < totals.get('chunks', 0):
+		return
+	redis.delete(run)
+	print(
+		'Price refresh completed: {:.0f} chunks ({:.0f} failed), {:.0f} '
+		'printings, {:.0f} requests, {:.0f} prices written in {:.0f}s.'.format(
+			totals['chunks'], totals['failed'], totals['printings'],
+			totals['lots'], totals['rows'], time.time() - totals['started']
+		)
+	)
+
+
+def fetch_prices(cards: list, group_mode: bool = False) -> dict:
+	checked = [c.id for c in cards]
+
+	# Match up cards without TCGPlayer IDs, one product listing per set
+	unmatched = [c for c in cards if c.productid is None]
+	if unmatched:
+		productids = tcgplayer.resolve_products(unmatched, search_unmatched=False)
+		if productids:
+			collection.set_productids(productids)
+		cards = [
+			c._replace(productid=str(productids[c.id]))
+			if c.id in productids else c
+			for c in cards
+		]
+
 	# Filter out cards without tcgplayerid to save requests
-	cards = [c for c in cards if c['productid'] is not None]
-	bulk_lots = ([cards[i:i + 250] for i in range(0, len(cards), 250)])
-	for lot in bulk_lots:
-		card_dict = {
-			str(c['id']): str(c['productid'])
-			for c in lot
-			if c['productid'] is not None
-		}
-		prices = tcgplayer.get_price(
-			card_dict,
-			token=tcgplayer_token
+	cards = [c for c in cards if c.productid is not None]
+
+	# Up to PRICE_WORKERS lot requests run ahead of the single DB writer below,
+	# which consumes them in order and so applies backpressure to fetching
+	stats = {'lots': 0, 'fetch_time': 0.0, 'rows': 0, 'write_time': 0.0}
+	started = time.monotonic()
+	lots = _price_lots(cards, group_mode)
+	fetched = functions.imap_bounded(_fetch_lot, lots, PRICE_WORKERS)
+	for prices, fetch_time in fetched:
+		stats['lots'] += 1
+		stats['fetch_time'] += fetch_time
+
+		write_start = time.monotonic()
+		stats['rows'] += set_prices(prices)
+		stats['write_time'] += time.monotonic() - write_start
+
+	elapsed = time.monotonic() - started
+	print(
+		'Fetched {} lots ({:.2f}s upstream), wrote {} prices ({:.2f}s DB) '
+		'in {:.2f}s, {:.1f} prices/s.'.format(
+			stats['lots'], stats['fetch_time'],
+			stats['rows'], stats['write_time'],
+			elapsed, stats['rows'] / elapsed if elapsed else 0
 		)
-		set_prices(prices)
-	print('Price update completed.')
+	)
+	# Cards that got no price are stamped too, so they wait a bulk interval
+	# instead of being due again on every run
+	pricing.mark_checked(checked)
+	stats['printings'] = len(cards)
+	return stats
+
+
+def _price_lots(cards: list, group_mode: bool) -> any:
+	# Yields (groupid, cards) lots, groupid None meaning a product id lookup
+	if not group_mode:
+		for lot in functions.batched(cards, 250):
+			yield None, lot
+		return
 
-	# Try to match up cards without TCGPlayer IDs
+	groups = {}
 	for c in cards:
-		if c['productid'] is None:
-			print(f"Searching for TCGPlayer ID for {c['name']} ({c['set_name']}).")
-			c['productid'] = tcgplayer.search(c, token=tcgplayer_token)
-			if c['productid'] is not None:
-				mutate_query(
-					"UPDATE printing SET tcgplayer_productid = %s WHERE id = %s",
-					(c['productid'], c['id'],)
-				)
+		groups.setdefault(c.groupid, []).append(c)
+	for groupid, group_cards in groups.items():
+		if groupid is None:
+			for lot in functions.batched(group_cards, 250):
+				yield None, lot
+		else:
+			yield groupid, group_cards
 
 
-def set_prices(prices):
+def _fetch_lot(lot: tuple) -> tuple:
+	groupid, cards = lot
+	card_dict = {str(c.id): str(c.productid) for c in cards}
+	fetch_start = time.monotonic()
+	if groupid is None:
+		prices = tcgplayer.get_price(card_dict)
+	else:
+		prices = tcgplayer.get_group_prices(groupid, card_dict)
+	return prices, time.monotonic() - fetch_start
+
+
+def set_prices(prices: dict) -> int:
 	updates = []
 	for cardid, price in prices.items():
 		# Only update if we received have prices
@@ -113,21 +250,107 @@ def set_prices(prices):
 				'price': price['normal'],
 				'foilprice': price['foil'],
 				'pricetype': price['type'],
-				'id': cardid
+				'id': int(cardid)
 			})
 
 	print('Updating prices for {} cards.'.format(len(updates)))
+	if not updates:
+		return 0
+
+	# Stage the whole lot once, then update printing and append history
+	# set-based instead of calling set_price() per row
 	mutate_query(
 		"""
-		SELECT set_price(
-			%(id)s,
-			%(price)s::MONEY,
-			%(foilprice)s::MONEY,
-			%(pricetype)s)
+		WITH staged AS (
+			SELECT
+				s.id, s.price::MONEY AS price, s.foilprice::MONEY AS foilprice,
+				s.pricetype
+			FROM json_to_recordset(%s::JSON) AS s(
+				id INTEGER, price NUMERIC, foilprice NUMERIC, pricetype TEXT
+			)
+		), updated AS (
+			UPDATE printing p SET
+				price = s.price,
+				foilprice = s.foilprice,
+				price_updated = current_date
+			FROM staged s
+			WHERE p.id = s.id
+		)
+		INSERT INTO price_history (printingid, price, foilprice, pricetype)
+		SELECT id, price, foilprice, pricetype FROM staged
+		ON CONFLICT (printingid, created) DO NOTHING
 		""",
-		updates,
-		executemany=True
+		(json.dumps(updates),)
+	)
+	pricing.bump_generation()
+	return len(updates)
+
+
+@celery.task(queue='collector', acks_late=True, reject_on_worker_lost=True)
+def run_import(importid: int) -> None:
+	# Late acks requeue the job if the worker dies, and every chunk is
+	# committed as it completes, so a rerun picks up from the first pending row
+	attempts = mutate_query(
+		"""
+		UPDATE import SET
+			started = COALESCE(started, now()),
+			heartbeat = now(),
+			attempts = attempts + 1
+		WHERE id = %s
+		RETURNING attempts
+		""",
+		(importid,),
+		returning=True
+	)['attempts']
+	try:
+		if attempts <= IMPORT_ATTEMPTS:
+			collection.resolve_import(importid)
+	finally:
+		# Whatever did resolve is applied even if resolving the rest failed
+		while collection.complete_import(importid) > 0:
+			collection.touch_import(importid)
+	collection.finish_import(importid)
+	print('Import {} completed.'.format(importid))
+
+
+@celery.task(queue='collector')
+def resume_imports() -> None:
+	# run_import() beats after every batch, so an import that beat recently is
+	# still running and must not get a second, concurrent run
+	imports = fetch_query(
+		"""
+		SELECT id FROM import
+		WHERE finished IS NULL
+		AND COALESCE(heartbeat, uploaded) < now() - '10 minutes'::INTERVAL
+		AND EXISTS (
+			SELECT 1 FROM import_row WHERE importid = import.id AND NOT complete
+		)
+		"""
 	)
+	for i in imports:
+		print('Resuming import {}.'.format(i['id']))
+		run_import.delay(i['id'])
+
+
+@celery.task(queue='collector')
+def compact_price_history() -> None:
+	# Runs monthly, so next month's partition is always in place before the
+	# first ingest that needs it
+	mutate_query(
+		"""
+		SELECT
+			ensure_price_history_partition(current_date),
+			ensure_price_history_partition(
+				(current_date + '1 month'::INTERVAL)::DATE
+			)
+		"""
+	)
+	compacted = mutate_query(
+		"SELECT compact_price_history(%s::INTERVAL, %s) AS compacted",
+		(PRICE_HISTORY_COMPACT_AFTER, PRICE_HISTORY_ROLLUP,),
+		returning=True
+	)['compacted']
+	print('Compacted {} price history partitions.'.format(compacted))
 
 
 @celery.task(queue='collector')
@@ -147,3 +370,21 @@ def fetch_rates() -> None:
 def refresh_from_scryfall(query: str) -> None:
 	resp = scryfall.search(query)
 	collection.import_cards(resp)
+
+
+@celery.task(queue='collector')
+def import_bulk_file(filename: str) -> None:
+	collection.import_bulk_file(filename)
+	print('Bulk file import completed.')
+
+
+@celery.task(queue='collector')
+def build_catalogue() -> None:
+	filename = '{}.bulk.json'.format(catalogue.CATALOGUE_FILE)
+	print('Downloading Scryfall bulk file')
+	scryfall.download_bulk_file(filename)
+	try:
+		count = catalogue.build(scryfall.bulk_file_import(filename))
+	finally:
+		os.remove(filename)
+	print('Built catalogue of {} cards.'.format(count))
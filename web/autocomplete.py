@@ -0,0 +1,173 @@
+# Standard library imports
+import bisect
+import json
+import threading
+import unicodedata
+
+# Third party imports
+from flask import current_app
+
+# Local imports
+from web import functions
+from flasktools.db import fetch_query
+
+# Process-wide prefix index of normalized card names -> printing ids. Each
+# add() bumps VERSION_KEY and publishes its {name: ids} delta to DELTAS_KEY in
+# the same transaction, so other processes merge the deltas they missed
+# instead of rebuilding. The list keeps the last DELTAS_KEPT, a process
+# further behind rebuilds in the background and serves its old copy meanwhile.
+VERSION_KEY = 'collector:autocomplete:version'
+DELTAS_KEY = 'collector:autocomplete:deltas'
+DELTAS_KEPT = 1000
+
+# Sorted (key, name) pairs, one per word start of each name
+_keys = []
+_printings = {}
+_version = None
+_rebuilding = False
+_lock = threading.Lock()
+
+
+def normalize(name: str) -> str:
+	name = unicodedata.normalize('NFKD', name)
+	name = ''.join(ch for ch in name if not unicodedata.combining(ch))
+	return ' '.join(name.lower().replace('æ', 'ae').split())
+
+
+def _index_keys(name: str) -> list:
+	# The full name plus every later word so "bolt" completes "Lightning Bolt"
+	words = normalize(name).split(' ')
+	return [(' '.join(words[i:]), name) for i in range(len(words))]
+
+
+def _current_version() -> int:
+	return int(functions.get_redis().get(VERSION_KEY) or 0)
+
+
+def _build(version: int) -> None:
+	global _keys, _printings, _version
+	resp = fetch_query(
+		"""
+		SELECT c.name, array_agg(p.id ORDER BY s.released DESC, p.id) AS printings
+		FROM printing p
+		LEFT JOIN card c ON (p.cardid = c.id)
+		LEFT JOIN card_set s ON (p.card_setid = s.id)
+		GROUP BY c.name
+		"""
+	)
+	printings = {r['name']: r['printings'] for r in resp}
+	keys = sorted(k for name in printings for k in _index_keys(name))
+	_keys, _printings, _version = keys, printings, version
+
+
+def warm() -> None:
+	# Called as each web worker starts, so no search waits for the build
+	with _lock:
+		if _version is None:
+			_build(_current_version())
+
+
+def _merge(deltas: list, version: int) -> None:
+	# Copy on write so concurrent completions see a consistent index
+	global _keys, _printings, _version
+	keys = list(_keys)
+	merged = dict(_printings)
+	for printings in deltas:
+		for name, ids in printings.items():
+			if name not in merged:
+				for k in _index_keys(name):
+					bisect.insort(keys, k)
+			# A delta can overlap a build that already read its printings
+			existing = [x for x in merged.get(name, []) if x not in ids]
+			merged[name] = ids + existing
+	_keys, _printings, _version = keys, merged, version
+
+
+def _catch_up(version: int) -> bool:
+	# Merges the deltas published since our version, False if some of them
+	# are no longer kept and the index has to be rebuilt
+	behind = version - _version
+	if behind < 0:
+		# The version went backwards, Redis lost its data
+		return False
+	pipe = functions.get_redis().pipeline()
+	pipe.get(VERSION_KEY)
+	pipe.lrange(DELTAS_KEY, -behind, -1)
+	latest, deltas = pipe.execute()
+	latest = int(latest or 0)
+	if len(deltas) < behind:
+		return False
+	if latest != version:
+		# More were published since version was read, the next search retries
+		return True
+	_merge([json.loads(d) for d in deltas], version)
+	return True
+
+
+def _rebuild() -> None:
+	global _rebuilding
+	_rebuilding = True
+	app = current_app._get_current_object()
+
+	def run() -> None:
+		global _rebuilding
+		try:
+			with app.app_context():
+				_build(_current_version())
+		finally:
+			_rebuilding = False
+
+	threading.Thread(target=run, daemon=True).start()
+
+
+def _refresh() -> None:
+	version = _current_version()
+	if version == _version:
+		return
+	if _version is None:
+		# Not warmed at startup, e.g. under the development server
+		warm()
+		return
+	with _lock:
+		if _rebuilding or version == _version:
+			return
+		if not _catch_up(version):
+			_rebuild()
+
+
+def add(printings: dict) -> None:
+	# printings maps card name -> new printing ids
+	if not printings:
+		return
+	pipe = functions.get_redis().pipeline()
+	pipe.incr(VERSION_KEY)
+	pipe.rpush(DELTAS_KEY, json.dumps(printings))
+	pipe.ltrim(DELTAS_KEY, -DELTAS_KEPT, -1)
+	pipe.execute()
+
+
+def complete(query: str, limit: int = 50) -> list:
+	# Printing ids for names starting with query (or with a later word that
+	# does), exact match first, then full-name prefixes, then word prefixes
+	_refresh()
+	prefix = normalize(query)
+	if not prefix:
+		return []
+
+	keys, printings = _keys, _printings
+	matches = {}
+	i = bisect.bisect_left(keys, (prefix,))
+	while i < len(keys) and keys[i][0].startswith(prefix):
+		key, name = keys[i]
+		full = key == normalize(name)
+		rank = 0 if full and key == prefix else 1 if full else 2
+		if rank < matches.get(name, 3):
+			matches[name] = rank
+		i += 1
+
+	printingids = []
+	for name in sorted(matches, key=lambda n: (matches[n], n)):
+		printingids.extend(printings.get(name, []))
+		if len(printingids) >= limit:
+			break
+	return printingids[:limit]
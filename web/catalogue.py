@@ -0,0 +1,199 @@
+# Standard library imports
+import json
+import mmap
+import os
+import struct
+import threading
+
+# Local imports
+from web import records, config
+
+CATALOGUE_FILE = getattr(
+	config, 'CATALOGUE_FILE', '/tmp/collector_catalogue.dat'
+)
+
+# File layout: one JSON card tuple per line, then sorted indexes of
+# fixed-width (key, byte offset) entries for scryfall ids, set/collector
+# numbers and names (one entry per printing), then a trailer locating them.
+# Lookups bisect the indexes in the mapping, so nothing is loaded into each
+# process's heap.
+MAGIC = b'MTGCAT03'
+SECTION = struct.Struct('<QQQ')
+TRAILER = struct.Struct('<QQQQQQQQQ8s')
+OFFSET = struct.Struct('<Q')
+
+_opened = None
+_lock = threading.Lock()
+
+
+def _index_key(code: str, collectornumber: str) -> bytes:
+	return '{}/{}'.format(code.upper(), collectornumber).encode('utf-8')
+
+
+def _name_key(name: str) -> bytes:
+	return ' '.join(name.lower().split()).encode('utf-8')
+
+
+def _write_section(f: any, entries: list) -> tuple:
+	# entries are (key, offset) pairs, null padding keeps their sort order
+	start = f.tell()
+	width = max((len(k) for k, _ in entries), default=1)
+	for key, offset in sorted(entries):
+		f.write(key.ljust(width, b'\0'))
+		f.write(OFFSET.pack(offset))
+	return start, len(entries), width
+
+
+def build(cards: any, filename: str = CATALOGUE_FILE) -> int:
+	numbers = {}
+	ids = {}
+	names = []
+	count = 0
+	tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+	with open(tmpname, 'wb') as f:
+		for c in cards:
+			offset = f.tell()
+			f.write(json.dumps(tuple(c), separators=(',', ':')).encode('utf-8'))
+			f.write(b'\n')
+			numbers[_index_key(c.set, c.collectornumber)] = offset
+			ids[c.scryfallid.encode('utf-8')] = offset
+			names.append((_name_key(c.name), offset))
+			count += 1
+
+		sections = (
+			_write_section(f, list(ids.items()))
+			+ _write_section(f, list(numbers.items()))
+			+ _write_section(f, names)
+		)
+		f.write(TRAILER.pack(*sections, MAGIC))
+		f.flush()
+		os.fsync(f.fileno())
+
+	# Readers holding the old file keep their mapping until they next check
+	os.replace(tmpname, filename)
+	return count
+
+
+def _open() -> tuple:
+	global _opened
+	try:
+		stat = os.stat(CATALOGUE_FILE)
+	except FileNotFoundError:
+		return None
+	version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+	with _lock:
+		if _opened is None or _opened[0] != version:
+			with open(CATALOGUE_FILE, 'rb') as f:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			magic = data[-len(MAGIC):]
+			if magic != MAGIC:
+				# Written by an older version, ignored until the next rebuild
+				data.close()
+				_opened = None
+				return None
+			fields = TRAILER.unpack(data[-TRAILER.size:])
+			_opened = (version, data, fields[0:3], fields[3:6], fields[6:9])
+		return _opened
+
+
+def _entry(data: mmap.mmap, section: tuple, i: int) -> tuple:
+	start, _, width = section
+	pos = start + i * (width + OFFSET.size)
+	return data[pos:pos + width], OFFSET.unpack_from(data, pos + width)[0]
+
+
+def _bisect(data: mmap.mmap, section: tuple, key: bytes) -> int:
+	# Index of the first entry whose key is not less than key
+	_, count, width = section
+	key = key.ljust(width, b'\0')
+	lo, hi = 0, count
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if _entry(data, section, mid)[0] < key:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+
+def _find(data: mmap.mmap, section: tuple, key: bytes) -> int:
+	_, count, width = section
+	if len(key) > width:
+		return None
+	i = _bisect(data, section, key)
+	if i < count:
+		found, offset = _entry(data, section, i)
+		if found == key.ljust(width, b'\0'):
+			return offset
+	return None
+
+
+def _find_prefix(
+	data: mmap.mmap,
+	section: tuple,
+	prefix: bytes,
+	limit: int = None
+) -> list:
+	# (key, offset) of every entry starting with prefix, in key order
+	_, count, width = section
+	if len(prefix) > width:
+		return []
+	matches = []
+	i = _bisect(data, section, prefix)
+	while i < count and (limit is None or len(matches) < limit):
+		key, offset = _entry(data, section, i)
+		if not key.startswith(prefix):
+			break
+		matches.append((key.rstrip(b'\0'), offset))
+		i += 1
+	return matches
+
+
+def _read(data: mmap.mmap, offset: int) -> records.Card:
+	end = data.find(b'\n', offset)
+	return records.Card._make(json.loads(data[offset:end]))
+
+
+def get(code: str, collectornumber: str) -> records.Card:
+	opened = _open()
+	if opened is None:
+		return None
+	_, data, _, numbers, _ = opened
+	offset = _find(data, numbers, _index_key(code, collectornumber))
+	if offset is None:
+		return None
+	return _read(data, offset)
+
+
+def get_bulk(scryfall_ids: list) -> tuple:
+	opened = _open()
+	if opened is None:
+		return [], list(scryfall_ids)
+	_, data, ids, _, _ = opened
+	found = []
+	missing = []
+	for scryfallid in scryfall_ids:
+		offset = _find(data, ids, scryfallid.encode('utf-8'))
+		if offset is None:
+			missing.append(scryfallid)
+		else:
+			found.append(_read(data, offset))
+	return found, missing
+
+
+def search(name: str, limit: int = None) -> list:
+	# Every printing of the named card, or of the cards whose names start with
+	# name when none is called exactly that
+	opened = _open()
+	if opened is None:
+		return []
+	_, data, _, _, names = opened
+	key = _name_key(name)
+	if not key:
+		return []
+	matches = _find_prefix(data, names, key, limit)
+	offsets = [offset for k, offset in matches if k == key]
+	if not offsets:
+		offsets = [offset for _, offset in matches]
+	return [_read(data, offset) for offset in offsets]
@@ -1,11 +1,35 @@
+# Standard library imports
+import base64
+import codecs
+import csv
+import json
+
 # Third party imports
 from flask import session
 
 # Local imports
-from web import scryfall, tcgplayer, functions
+from web import scryfall, catalogue, lookup, autocomplete, functions
 from flasktools import strip_unicode_characters, serve_static_file
 from flasktools.db import fetch_query, mutate_query
 
+# The user's exchange rate is joined once per query rather than looked up by
+# get_price() for every row; uc.userid pins both joins to a single row
+RATE_JOIN = """
+	LEFT JOIN app.enduser eu ON (eu.id = uc.userid)
+	LEFT JOIN currency cur ON (cur.code = eu.currencycode)
+"""
+BASE_PRICE = "CASE WHEN uc.foil = true THEN p.foilprice ELSE p.price END"
+PRICE = f"(({BASE_PRICE}) * COALESCE(cur.exchangerate, 1))"
+
+
+# Columns each filter applies to, on the card joins or the summary tables
+CARD_FILTERS = {
+	'search': 'p.cardid',
+	'set': 'p.card_setid',
+	'rarity': 'p.rarity'
+}
+SUMMARY_FILTERS = {'set': 's.card_setid', 'rarity': 's.rarity'}
+
 
 def get(params: dict) -> dict:
 	resp = {}
@@ -23,79 +47,94 @@ def get(params: dict) -> dict:
 		'rarity': "get_rarity_sort(p.rarity)",
 		'quantity': 'uc.quantity',
 		'foil': 'uc.foil',
-		'price': 'get_price(uc.id)'
+		'price': PRICE
 	}
-	sort = cols.get(params.get('sort'), 'c.name')
+	sort_name = params.get('sort') if params.get('sort') in cols else 'name'
+	sort = cols[sort_name]
 	descs = {'asc': 'ASC', 'desc': 'DESC'}
 	sort_desc = descs.get(params.get('sort_desc'), 'ASC')
+	order = f"{sort} {sort_desc} NULLS LAST, cs.code, p.collectornumber, uc.id"
+
+	# A cursor from the previous page replaces the offset, but only if it was
+	# issued for the same ordering
+	cursor = decode_cursor(params.get('cursor'))
+	if cursor is not None and cursor['sort'] != [sort_name, sort_desc]:
+		cursor = None
 
 	# Filters
-	search = f"%{params['filter_search']}%" if params['filter_search'] else None
 	filters = {
-		'search': search,
+		'search': params.get('filter_search'),
 		'set': params.get('filter_set'),
 		'rarity': params.get('filter_rarity')
 	}
 
-	qry = """SELECT count(1) AS count,
-				sum(uc.quantity) AS sum,
-				sum(uc.quantity * get_price(uc.id)) AS sumprice
-			FROM user_card uc
-			LEFT JOIN printing p ON (p.id = uc.printingid)
-			WHERE uc.userid = %s"""
-	qargs = (session['userid'],)
-	if filters['search']:
-		qry += " AND (SELECT name FROM card WHERE id = p.cardid) ILIKE %s"
-		qargs += (filters['search'],)
-	if filters['set']:
-		qry += " AND p.card_setid = %s"
-		qargs += (filters['set'],)
-	if filters['rarity']:
-		qry += " AND p.rarity = %s"
-		qargs += (filters['rarity'],)
-	aggregate = fetch_query(qry, qargs, single_row=True)
-	resp['count'] = functions.pagecount(aggregate['count'], limit)
-	resp['total'] = aggregate['sum']
-	resp['totalprice'] = aggregate['sumprice']
+	totals, qargs = _totals_query(filters)
+
+	where, where_args = filter_clause(filters, CARD_FILTERS)
+	qargs += (session['userid'],) + where_args
+	if cursor is not None:
+		# Rows after the cursor in ORDER BY order, NULL sort keys come last
+		after = "(cs.code, p.collectornumber, uc.id) > (%s, %s, %s)"
+		if cursor['key'] is None:
+			where += f" AND {sort} IS NULL AND {after}"
+			qargs += tuple(cursor['after'])
+		else:
+			op = '>' if sort_desc == 'ASC' else '<'
+			where += f""" AND (
+				{sort} {op} %s
+				OR ({sort} = %s AND {after})
+				OR {sort} IS NULL
+			)"""
+			qargs += (cursor['key'], cursor['key'],) + tuple(cursor['after'])
+		offset = 0
+	qargs += (limit, offset,)
 
-	qry = """SELECT
+	# Totals and the page in one round trip
+	result = fetch_query(
+		f"""
+		WITH totals AS ({totals}), page AS (
+			SELECT
 				p.id, uc.id AS user_cardid, c.name, cs.name AS setname, cs.code AS setcode,
 				get_rarity(p.rarity) AS rarity, uc.quantity, uc.foil,
-				get_price(uc.id) AS price,
-				get_base_price(uc.id) AS base_price,
-				COALESCE(
-					(SELECT currencycode FROM app.enduser WHERE id = uc.userid),
-					'USD'
-				) AS currencycode,
-				p.collectornumber, p.card_setid,
-				CASE WHEN p.language != 'en' THEN UPPER(p.language) END AS language
+				{PRICE} AS price,
+				{BASE_PRICE} AS base_price,
+				COALESCE(eu.currencycode, 'USD') AS currencycode,
+				p.collectornumber,
+				CASE WHEN p.language != 'en' THEN UPPER(p.language) END AS language,
+				{sort} AS sortkey,
+				row_number() OVER (ORDER BY {order}) AS n
 			FROM user_card uc
 			LEFT JOIN printing p ON (uc.printingid = p.id)
 			LEFT JOIN card c ON (p.cardid = c.id)
 			LEFT JOIN card_set cs ON (p.card_setid = cs.id)
-			WHERE uc.userid = %s"""
-	qargs = (session['userid'],)
+			{RATE_JOIN}
+			WHERE uc.userid = %s{where}
+			ORDER BY {order}
+			LIMIT %s
+			OFFSET %s
+		)
+		SELECT
+			t.count, t.sum, t.sumprice,
+			(SELECT COALESCE(json_agg(page ORDER BY n), '[]') FROM page) AS cards
+		FROM totals t
+		""",
+		qargs,
+		single_row=True
+	)
+	resp['count'] = functions.pagecount(result['count'], limit)
+	resp['total'] = result['sum']
+	resp['totalprice'] = result['sumprice']
+	resp['cards'] = result['cards']
 
-	if filters['search']:
-		qry += " AND c.name ILIKE %s"
-		qargs += ('%' + filters['search'] + '%',)
-	if filters['set']:
-		qry += " AND p.card_setid = %s"
-		qargs += (filters['set'],)
-	if filters['rarity']:
-		qry += " AND p.rarity = %s"
-		qargs += (filters['rarity'],)
+	resp['cursor'] = None
+	if len(resp['cards']) == limit:
+		last = resp['cards'][-1]
+		resp['cursor'] = encode_cursor(
+			[sort_name, sort_desc],
+			last['sortkey'],
+			[last['setcode'], last['collectornumber'], last['user_cardid']]
+		)
 
-	qry += """ ORDER BY
-				%s %s,
-				cs.code,
-				p.collectornumber
-			LIMIT
-				%%s
-			OFFSET %%s
-			""" % (sort, sort_desc)
-	qargs += (limit, offset,)
-	resp['cards'] = fetch_query(qry, qargs)
 	for c in resp['cards']:
 		c['imageurl'] = serve_static_file('images/card_image_{}.jpg'.format(c['id']))
 		c['arturl'] = serve_static_file('images/card_art_{}.jpg'.format(c['id']))
@@ -104,11 +143,124 @@ def get(params: dict) -> dict:
 			c['base_price'] = None
 
 		# Remove keys unnecessary in response
-		del c['card_setid']
+		del c['sortkey']
+		del c['n']
 
 	return resp
 
 
+def filter_clause(filters: dict, columns: dict) -> tuple:
+	# " AND ..." predicates and their arguments for the filters set, using the
+	# given column for each
+	qry = ''
+	qargs = ()
+	if filters['search']:
+		qry += f" AND {columns['search']} IN (SELECT cardid FROM search_cards(%s))"
+		qargs += (filters['search'],)
+	if filters['set']:
+		qry += f" AND {columns['set']} = %s"
+		qargs += (filters['set'],)
+	if filters['rarity']:
+		qry += f" AND {columns['rarity']} = %s"
+		qargs += (filters['rarity'],)
+	return qry, qargs
+
+
+def encode_cursor(sort: list, key: any, after: list) -> str:
+	# Sort keys without a JSON type (dates, money, numerics) travel as text
+	# and are cast back by Postgres when compared against the column
+	if key is not None and not isinstance(key, (bool, int, float, str)):
+		key = str(key)
+	data = json.dumps({'sort': sort, 'key': key, 'after': after})
+	return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> dict:
+	if not cursor:
+		return None
+	try:
+		data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+	except ValueError:
+		return None
+	if not isinstance(data, dict):
+		return None
+	sort, key, after = data.get('sort'), data.get('key'), data.get('after')
+	if (
+		not isinstance(sort, list)
+		or len(sort) != 2
+		or not all(isinstance(x, str) for x in sort)
+	):
+		return None
+	if key is not None and not isinstance(key, (bool, int, float, str)):
+		return None
+	if (
+		not isinstance(after, list)
+		or len(after) != 3
+		or not isinstance(after[0], str)
+		or not isinstance(after[1], str)
+		or isinstance(after[2], bool)
+		or not isinstance(after[2], int)
+	):
+		return None
+	return {'sort': sort, 'key': key, 'after': after}
+
+
+def _totals_query(filters: dict) -> tuple:
+	# Single row of count, sum and sumprice. Set and rarity totals are kept in
+	# collection_summary by triggers, only a name search still needs to
+	# aggregate the user's cards.
+	if filters['search']:
+		where, qargs = filter_clause(filters, CARD_FILTERS)
+		qry = f"""SELECT count(1) AS count,
+					sum(uc.quantity) AS sum,
+					sum(uc.quantity * {PRICE}) AS sumprice
+				FROM user_card uc
+				LEFT JOIN printing p ON (p.id = uc.printingid)
+				{RATE_JOIN}
+				WHERE uc.userid = %s{where}"""
+		return qry, (session['userid'],) + qargs
+
+	if not filters['set'] and not filters['rarity']:
+		qry = """SELECT
+					COALESCE(s.cards, 0) AS count,
+					s.quantity AS sum,
+					s.value * COALESCE(cur.exchangerate, 1) AS sumprice
+				FROM app.enduser eu
+				LEFT JOIN user_collection_summary s ON (s.userid = eu.id)
+				LEFT JOIN currency cur ON (cur.code = eu.currencycode)
+				WHERE eu.id = %s"""
+		return qry, (session['userid'],)
+
+	where, qargs = filter_clause(filters, SUMMARY_FILTERS)
+	qry = f"""SELECT
+				COALESCE(sum(s.cards), 0) AS count,
+				sum(s.quantity) AS sum,
+				sum(s.value * COALESCE(cur.exchangerate, 1)) AS sumprice
+			FROM collection_summary s
+			LEFT JOIN app.enduser eu ON (eu.id = s.userid)
+			LEFT JOIN currency cur ON (cur.code = eu.currencycode)
+			WHERE s.userid = %s{where}"""
+	return qry, (session['userid'],) + qargs
+
+
+def get_exchange_rate() -> float:
+	rate = fetch_query(
+		"""
+		SELECT COALESCE(
+			(
+				SELECT exchangerate FROM currency WHERE code = (
+					SELECT currencycode FROM app.enduser WHERE id = %s
+				)
+			),
+			1
+		) AS rate
+		""",
+		(session['userid'],),
+		single_row=True
+	)['rate']
+	return float(rate)
+
+
 def add(printingid: int, foil: bool, quantity: int) -> None:
 	existing = fetch_query(
 		"""
@@ -170,150 +322,388 @@ def remove(printingid: int, foil: bool, quantity: int) -> None:
 		raise Exception('Could not find card {}.'.format(printingid))
 
 
-def import_cards(cards: list) -> None:
-	sets = []
-	for c in cards:
-		if c['set'] not in [x['code'] for x in sets]:
-			sets.append({'code': c['set'], 'name': c['set_name']})
-
-	for s in sets:
-		# Check if already have a record of this set
-		existing = fetch_query(
-			"SELECT 1 FROM card_set WHERE LOWER(code) = LOWER(%s)",
-			(s['code'],)
-		)
-		if not existing:
-			resp = scryfall.get_set(s['code'])
-			mutate_query(
-				"""
-				INSERT INTO card_set (
-					name, code, released, tcgplayer_groupid
-				) SELECT
-					%s, %s, %s, %s
-				WHERE NOT EXISTS (SELECT * FROM card_set WHERE code = %s)
-				""",
-				(
-					resp['name'],
-					s['code'],
-					resp['released_at'],
-					resp.get('tcgplayer_id'),
-					s['code'],
-				)
+def parse_csv(stream: any) -> list:
+	# Read straight from the upload stream instead of spooling to disk
+	reader = csv.DictReader(codecs.getreader('utf-8-sig')(stream))
+	return [
+		{
+			'scryfallid': row['Scryfall ID'],
+			'foil': int(row['Foil quantity']) > 0,
+			'quantity': int(row['Quantity'])
+		}
+		for row in reader
+	]
+
+
+def create_import(filename: str, contenthash: str, rows: list) -> int:
+	importid = mutate_query(
+		"""
+		WITH new_import AS (
+			INSERT INTO import (filename, userid, contenthash)
+			VALUES (%s, %s, %s)
+			RETURNING id
+		), new_rows AS (
+			INSERT INTO import_row (importid, scryfallid, foil, quantity)
+			SELECT i.id, r.scryfallid, r.foil, r.quantity
+			FROM new_import i, json_to_recordset(%s::JSON) AS r(
+				scryfallid TEXT, foil BOOLEAN, quantity INTEGER
 			)
+		)
+		SELECT id FROM new_import
+		""",
+		(filename, session['userid'], contenthash, json.dumps(rows),),
+		returning=True
+	)['id']
+	return importid
+
+
+def find_import(contenthash: str) -> dict:
+	return fetch_query(
+		"""
+		SELECT id, finished IS NOT NULL AS finished, COALESCE(failed, 0) AS failed
+		FROM import
+		WHERE userid = %s
+		AND contenthash = %s
+		""",
+		(session['userid'], contenthash,),
+		single_row=True
+	)
+
+
+def retry_import(importid: int) -> None:
+	# Requeue only the rows that failed, the rest are already in user_card
+	mutate_query(
+		"""
+		WITH reset AS (
+			UPDATE import_row SET complete = false, failed = false
+			WHERE importid = %s
+			AND failed
+		)
+		UPDATE import SET
+			finished = NULL, attempts = 0, imported = NULL, failed = NULL,
+			heartbeat = now()
+		WHERE id = %s
+		""",
+		(importid, importid,)
+	)
+
+
+def touch_import(importid: int) -> None:
+	# Marks a running import as alive so resume_imports() leaves it alone
+	mutate_query(
+		"UPDATE import SET heartbeat = now() WHERE id = %s",
+		(importid,)
+	)
+
 
-	# more efficient than attempting inserts
+def resolve_import(importid: int) -> None:
 	resp = fetch_query(
-		"SELECT DISTINCT scryfallid FROM printing WHERE scryfallid IS NOT NULL"
+		"""
+		SELECT DISTINCT scryfallid FROM import_row
+		WHERE importid = %s
+		AND printingid IS NULL
+		""",
+		(importid,)
 	)
-	scryfall_ids = [x['scryfallid'] for x in resp]
+	scryfall_ids = [r['scryfallid'] for r in resp]
+	if not scryfall_ids:
+		return
 
-	new_cards = []
-	for c in cards:
-		if c['scryfallid'] in scryfall_ids:
-			print('Existing {}...'.format(c['scryfallid']))
-			continue
+	known = lookup.resolve(scryfall_ids)
+	new = [x for x in scryfall_ids if x not in known]
+	for resp in scryfall.iter_bulk(functions.batched(new, 75)):
+		import_cards(resp)
+		touch_import(importid)
+	# Anything Scryfall didn't return or import_cards skipped stays unresolved
+	# and is failed by finish_import()
 
-		existing = fetch_query(
-			"SELECT id FROM card WHERE LOWER(name) = LOWER(%s)",
-			(c['name'],),
-			single_row=True
+	printings = lookup.resolve(scryfall_ids)
+	mutate_query(
+		"""
+		UPDATE import_row r SET printingid = s.printingid
+		FROM json_to_recordset(%s::JSON) AS s(scryfallid TEXT, printingid INTEGER)
+		WHERE r.importid = %s
+		AND r.scryfallid = s.scryfallid
+		AND r.printingid IS NULL
+		""",
+		(
+			json.dumps([
+				{'scryfallid': k, 'printingid': v}
+				for k, v in printings.items()
+			]),
+			importid,
 		)
-		if existing:
-			cardid = existing['id']
-		else:
-			print('Inserting card {}'.format(c['name']))
-			new = mutate_query(
-				"""
-				INSERT INTO card (
-					name, colors, multifaced, cmc, typeline, manacost
-				) SELECT
-					%s, %s, %s, %s, %s, %s
-				WHERE NOT EXISTS (
-					SELECT 1 FROM card WHERE LOWER(name) = LOWER(%s)
-				) RETURNING id
-				""",
-				(
-					c['name'], c['colors'], c['multifaced'], c['cmc'],
-					strip_unicode_characters(c['typeline']), c['manacost'],
-					c['name'],
-				),
-				returning=True
+	)
+
+
+def complete_import(importid: int, limit: int = 1000) -> int:
+	# Marks a chunk of rows complete and merges it into user_card in one
+	# statement, so each chunk is a checkpoint an interrupted job resumes from
+	resp = mutate_query(
+		"""
+		WITH pending AS (
+			UPDATE import_row SET complete = true
+			WHERE id IN (
+				SELECT id FROM import_row
+				WHERE importid = %s
+				AND NOT complete
+				AND printingid IS NOT NULL
+				ORDER BY id
+				LIMIT %s
+				FOR UPDATE SKIP LOCKED
+			)
+			RETURNING printingid, foil, quantity
+		), totals AS (
+			SELECT
+				i.userid, r.printingid, r.foil,
+				SUM(r.quantity)::INTEGER AS quantity
+			FROM pending r
+			JOIN import i ON (i.id = %s)
+			GROUP BY i.userid, r.printingid, r.foil
+		), updated AS (
+			UPDATE user_card uc SET quantity = uc.quantity + t.quantity
+			FROM totals t
+			WHERE uc.userid = t.userid
+			AND uc.printingid = t.printingid
+			AND uc.foil = t.foil
+			RETURNING uc.printingid, uc.foil
+		), inserted AS (
+			INSERT INTO user_card (
+				printingid, userid, foil, quantity
+			) SELECT
+				t.printingid, t.userid, t.foil, t.quantity
+			FROM totals t
+			WHERE NOT EXISTS (
+				SELECT 1 FROM updated u
+				WHERE u.printingid = t.printingid
+				AND u.foil = t.foil
 			)
-			cardid = new['id']
+		)
+		SELECT count(1) AS count FROM pending
+		""",
+		(importid, limit, importid,),
+		returning=True
+	)
+	return resp['count']
 
-		new = mutate_query(
-			"""
+
+def finish_import(importid: int) -> None:
+	# Rows still without a printing can't be imported, so they are failed
+	# rather than left pending for resume_imports() to retry forever
+	mutate_query(
+		"""
+		WITH failed AS (
+			UPDATE import_row SET complete = true, failed = true
+			WHERE importid = %s
+			AND NOT complete
+			AND printingid IS NULL
+			RETURNING id
+		)
+		UPDATE import SET
+			finished = now(),
+			imported = (
+				SELECT count(1) FROM import_row
+				WHERE importid = import.id
+				AND complete
+				AND NOT failed
+			),
+			failed = (
+				SELECT count(1) FROM import_row
+				WHERE importid = import.id
+				AND failed
+			) + (SELECT count(1) FROM failed)
+		WHERE id = %s
+		""",
+		(importid, importid,)
+	)
+
+
+def get_import_progress(importid: int) -> dict:
+	progress = fetch_query(
+		"""
+		SELECT
+			i.id, i.filename,
+			count(r.id) AS total,
+			count(r.id) FILTER (WHERE r.complete AND NOT r.failed) AS done,
+			count(r.id) FILTER (WHERE r.failed) AS failed,
+			i.finished IS NOT NULL AS finished,
+			EXTRACT(EPOCH FROM COALESCE(i.finished, now()) - i.started) AS elapsed
+		FROM import i
+		LEFT JOIN import_row r ON (r.importid = i.id)
+		WHERE i.id = %s
+		AND i.userid = %s
+		GROUP BY i.id
+		""",
+		(importid, session['userid'],),
+		single_row=True
+	)
+	if progress:
+		elapsed = functions.make_float(progress.pop('elapsed'))
+		progress['rate'] = None
+		if elapsed:
+			progress['rate'] = round(progress['done'] / elapsed, 1)
+	return progress
+
+
+def import_from_catalogue(query: str, limit: int = 50) -> list:
+	# Printing ids of catalogue cards matching query, importing any the
+	# database doesn't have yet
+	cards = catalogue.search(query, limit)
+	if not cards:
+		return []
+	import_cards(cards)
+	printings = lookup.resolve([c.scryfallid for c in cards])
+	return [printings[c.scryfallid] for c in cards if c.scryfallid in printings]
+
+
+def import_cards(cards: list) -> dict:
+	known = lookup.resolve([c.scryfallid for c in cards])
+	cards = [c for c in cards if c.scryfallid not in known]
+	if not cards:
+		return {}
+
+	_import_sets(cards)
+
+	staged = json.dumps([
+		{
+			'n': n,
+			'name': c.name,
+			'colors': c.colors,
+			'multifaced': c.multifaced,
+			'cmc': c.cmc,
+			'typeline': strip_unicode_characters(c.typeline),
+			'manacost': c.manacost,
+			'collectornumber': c.collectornumber,
+			'multiverseid': c.multiverseid,
+			'scryfallid': c.scryfallid,
+			'set': c.set,
+			'rarity': c.rarity,
+			'language': c.language
+		}
+		for n, c in enumerate(cards)
+	])
+
+	mutate_query(
+		"""
+		INSERT INTO card (
+			name, colors, multifaced, cmc, typeline, manacost
+		) SELECT DISTINCT ON (LOWER(s.name))
+			s.name, s.colors, s.multifaced, s.cmc, s.typeline, s.manacost
+		FROM json_to_recordset(%s::JSON) AS s(
+			n INTEGER, name TEXT, colors TEXT, multifaced BOOLEAN, cmc NUMERIC,
+			typeline TEXT, manacost TEXT
+		)
+		ORDER BY LOWER(s.name), s.n
+		ON CONFLICT ((LOWER(name))) DO NOTHING
+		""",
+		(staged,)
+	)
+
+	# Single round trip for every new printing, keyed by scryfallid
+	new = mutate_query(
+		"""
+		WITH inserted AS (
 			INSERT INTO printing (
 				cardid, collectornumber, multiverseid, scryfallid,
 				card_setid,
 				rarity, language
-			) SELECT
-				%s, %s, %s, %s,
-				(SELECT id FROM card_set WHERE code = %s),
-				%s, %s
+			) SELECT DISTINCT ON (c.id, s.collectornumber, cs.id, s.language)
+				c.id, s.collectornumber, s.multiverseid, s.scryfallid,
+				cs.id,
+				s.rarity, s.language
+			FROM json_to_recordset(%s::JSON) AS s(
+				n INTEGER, name TEXT, collectornumber TEXT, multiverseid INTEGER,
+				scryfallid TEXT, set TEXT, rarity CHARACTER, language TEXT
+			)
+			JOIN card c ON (LOWER(c.name) = LOWER(s.name))
+			JOIN card_set cs ON (cs.code = s.set)
 			WHERE NOT EXISTS (
 				SELECT 1 FROM printing
-				WHERE cardid = %s
-				AND collectornumber = %s
-				AND card_setid = (SELECT id FROM card_set WHERE code = %s)
-			) RETURNING id
-			""",
-			(
-				cardid, c['collectornumber'], c['multiverseid'], c['scryfallid'],
-				c['set'],
-				c['rarity'], c['language'],
-				cardid, c['collectornumber'], c['set'],
-			),
-			returning=True
-		)
-		if new:
-			print('Inserted printing {}'.format(c['name']))
-			c['id'] = new['id']
-			c['set_code'] = c['set']  # Key needed for searching on tcgplayer
-			c['productid'] = tcgplayer.search(c)
-			if c['productid'] is not None:
-				mutate_query(
-					"""
-					UPDATE
-						printing
-					SET
-						tcgplayer_productid = %s
-					WHERE
-						id = %s AND
-						NOT is_basic_land(cardid)
-					""",
-					(c['productid'], c['id'],)
-				)
-				new_cards.append({'id': c['id'], 'productid': c['productid']})
-
-	bulk_lots = ([new_cards[i:i + 250] for i in range(0, len(new_cards), 250)])
-	prices = {}
-	for lot in bulk_lots:
-		prices.update(
-			tcgplayer.get_price({
-				str(c['id']): str(c['productid'])
-				for c in lot
-				if c['productid'] is not None
-			})
+				WHERE cardid = c.id
+				AND collectornumber = s.collectornumber
+				AND card_setid = cs.id
+				AND COALESCE(language, 'en') = COALESCE(s.language, 'en')
+			)
+			ORDER BY c.id, s.collectornumber, cs.id, s.language, s.n
+			ON CONFLICT (scryfallid) DO NOTHING
+			RETURNING id, scryfallid
 		)
+		SELECT COALESCE(json_object_agg(scryfallid, id), '{}') AS printings
+		FROM inserted
+		""",
+		(staged,),
+		returning=True
+	)['printings']
+	print('Inserted {} printings.'.format(len(new)))
+	lookup.add(new)
+
+	names = {}
+	for c in cards:
+		if c.scryfallid in new:
+			names.setdefault(c.name, []).append(new[c.scryfallid])
+	autocomplete.add(names)
 
-	updates = []
-	for printingid, price in prices.items():
-		updates.append({
-			'price': price['normal'],
-			'foilprice': price['foil'],
-			'id': printingid
+	# New printings have never been checked, so the next scheduled refresh
+	# treats them as due rather than the import waiting on TCGplayer
+	return new
+
+
+def _import_sets(cards: list) -> None:
+	codes = {c.set: c.set_name for c in cards}
+	existing = fetch_query(
+		"SELECT LOWER(code) AS code FROM card_set WHERE LOWER(code) = ANY(%s)",
+		([code.lower() for code in codes],)
+	)
+	existing = {x['code'] for x in existing}
+
+	sets = []
+	for code in codes:
+		if code.lower() in existing:
+			continue
+		resp = scryfall.get_set(code)
+		sets.append({
+			'name': resp['name'],
+			'code': code,
+			'released': resp['released_at'],
+			'tcgplayer_groupid': resp.get('tcgplayer_id')
 		})
+
+	if sets:
+		mutate_query(
+			"""
+			INSERT INTO card_set (
+				name, code, released, tcgplayer_groupid
+			) SELECT
+				s.name, s.code, s.released, s.tcgplayer_groupid
+			FROM json_to_recordset(%s::JSON) AS s(
+				name TEXT, code TEXT, released DATE, tcgplayer_groupid INTEGER
+			)
+			WHERE NOT EXISTS (SELECT 1 FROM card_set WHERE code = s.code)
+			""",
+			(json.dumps(sets),)
+		)
+
+
+def set_productids(productids: dict) -> None:
 	mutate_query(
 		"""
-		UPDATE
-			printing
-		SET
-			price = %(price)s,
-			foilprice = %(foilprice)s
-		WHERE
-			id = %(id)s
+		UPDATE printing p SET tcgplayer_productid = s.productid
+		FROM json_to_recordset(%s::JSON) AS s(id INTEGER, productid TEXT)
+		WHERE p.id = s.id
+		AND NOT is_basic_land(p.cardid)
 		""",
-		updates,
-		executemany=True
+		(
+			json.dumps([
+				{'id': printingid, 'productid': str(productid)}
+				for printingid, productid in productids.items()
+			]),
+		)
 	)
+
+
+def import_bulk_file(filename: str, batch_size: int = 1000) -> None:
+	# Stream the dump so peak memory is bound by batch_size, not file size
+	cards = scryfall.bulk_file_import(filename)
+	for batch in functions.batched(cards, batch_size):
+		print('Importing batch of {} cards.'.format(len(batch)))
+		import_cards(batch)
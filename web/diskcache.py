@@ -0,0 +1,80 @@
+# Standard library imports
+import hashlib
+import json
+import os
+import threading
+
+# Local imports
+from web import config
+
+CACHE_DIR = getattr(
+	config, 'SCRYFALL_CACHE_DIR', '/tmp/collector_scryfall_cache'
+)
+MAX_SIZE = getattr(config, 'SCRYFALL_CACHE_SIZE', 256 * 1024 * 1024)
+EVICT_EVERY = 100
+
+_stores = 0
+_lock = threading.Lock()
+
+
+def key(endpoint: str, params: any = None) -> str:
+	raw = json.dumps([endpoint, params], sort_keys=True, default=str)
+	return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _filename(cachekey: str) -> str:
+	return os.path.join(CACHE_DIR, '{}.json'.format(cachekey))
+
+
+def load(cachekey: str) -> dict:
+	filename = _filename(cachekey)
+	try:
+		with open(filename, 'rb') as f:
+			entry = json.loads(f.read())
+		# Access time drives LRU eviction, so bump it on every hit
+		os.utime(filename)
+	except (OSError, ValueError):
+		return None
+	return entry
+
+
+def store(cachekey: str, entry: dict) -> None:
+	global _stores
+	os.makedirs(CACHE_DIR, exist_ok=True)
+	filename = _filename(cachekey)
+	tmpname = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+	with open(tmpname, 'w', encoding='utf-8') as f:
+		json.dump(entry, f)
+	os.replace(tmpname, filename)
+
+	with _lock:
+		_stores += 1
+		evict = (_stores - 1) % EVICT_EVERY == 0
+	if evict:
+		_evict()
+
+
+def _evict() -> None:
+	entries = []
+	total = 0
+	with os.scandir(CACHE_DIR) as it:
+		for e in it:
+			if not e.name.endswith('.json'):
+				continue
+			try:
+				stat = e.stat()
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, e.path))
+			total += stat.st_size
+
+	# Least recently used first
+	entries.sort()
+	for mtime, size, path in entries:
+		if total <= MAX_SIZE:
+			break
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		total -= size
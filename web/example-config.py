@@ -3,12 +3,38 @@ TCGPLAYER_PUBLICKEY = 'publickey'
 TCGPLAYER_PRIVATEKEY = 'privatekey'
 OPENEXCHANGERATES_APPID = 'appid'
 
+REDIS_URL = 'redis://localhost:6379/0'
+
 DBHOST = 'localhost'
 DBPORT = '5432'
 DBNAME = 'collector'
 DBUSER = 'postgres'
 DBPASS = 'password'
 
+HTTP_TIMEOUT = 30
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_MIN_INTERVALS = {'api.scryfall.com': 0.1, 'api.tcgplayer.com': 0.1}
+
+SCRYFALL_CACHE_DIR = '/tmp/collector_scryfall_cache'
+SCRYFALL_CACHE_SIZE = 256 * 1024 * 1024
+SCRYFALL_WORKERS = 4
+
+PRICE_WORKERS = 4
+PRICE_REFRESH_HIGH_VALUE = 5
+PRICE_REFRESH_VOLATILITY = 0.2
+PRICE_REFRESH_BULK_DAYS = 7
+PRICE_REFRESH_BUDGET = 500
+PRICE_CHUNK_SIZE = 1000
+PRICE_HISTORY_COMPACT_AFTER = '1 year'
+PRICE_HISTORY_ROLLUP = 'week'
+
+# Runs of an import that try to resolve unknown cards before they are failed
+IMPORT_ATTEMPTS = 3
+
+CATALOGUE_FILE = '/tmp/collector_catalogue.dat'
+
 ROLLBAR_TOKEN = 'rollbartoken'
 
 SECRETKEY = 'secretkey'
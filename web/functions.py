@@ -1,4 +1,18 @@
 
+_redis = None
+
+
+def get_redis() -> any:
+	global _redis
+	if _redis is None:
+		import redis
+		from web import config
+		_redis = redis.Redis.from_url(
+			getattr(config, 'REDIS_URL', 'redis://localhost:6379/0')
+		)
+	return _redis
+
+
 def make_float(val: any) -> float:
 	try:
 		val = float(val)
@@ -19,3 +33,30 @@ def pagecount(count: int, limit: int) -> int:
 			if limit % count != 0:
 				pages = math.ceil(pages)
 	return int(pages)
+
+
+def batched(iterable: any, size: int) -> any:
+	batch = []
+	for item in iterable:
+		batch.append(item)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def imap_bounded(func: any, items: any, workers: int) -> any:
+	# Like map() over a thread pool, but results are yielded in order and at
+	# most twice the worker count are in flight, so callers can consume one
+	# result while the next ones are still being fetched
+	from collections import deque
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		pending = deque()
+		for item in items:
+			pending.append(executor.submit(func, item))
+			if len(pending) >= workers * 2:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
@@ -0,0 +1,75 @@
+# Standard library imports
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Third party imports
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Local imports
+from web import config
+
+TIMEOUT = getattr(config, 'HTTP_TIMEOUT', 30)
+POOL_SIZE = getattr(config, 'HTTP_POOL_SIZE', 10)
+RETRIES = getattr(config, 'HTTP_RETRIES', 3)
+BACKOFF = getattr(config, 'HTTP_BACKOFF', 0.5)
+# Minimum seconds between requests to a host, per upstream rate limits
+MIN_INTERVALS = getattr(config, 'HTTP_MIN_INTERVALS', {
+	'api.scryfall.com': 0.1,
+	'api.tcgplayer.com': 0.1
+})
+
+# One keep-alive session per upstream host, shared by all threads
+_sessions = {}
+_next_request = {}
+_lock = threading.Lock()
+
+
+def get_session(host: str) -> requests.Session:
+	with _lock:
+		if host not in _sessions:
+			retry = Retry(
+				total=RETRIES,
+				backoff_factor=BACKOFF,
+				status_forcelist=(429, 500, 502, 503, 504),
+				allowed_methods=frozenset(['GET', 'POST']),
+				raise_on_status=False
+			)
+			adapter = HTTPAdapter(
+				pool_connections=1,
+				pool_maxsize=POOL_SIZE,
+				max_retries=retry
+			)
+			session = requests.Session()
+			session.mount('https://', adapter)
+			session.mount('http://', adapter)
+			_sessions[host] = session
+		return _sessions[host]
+
+
+def _throttle(host: str) -> None:
+	interval = MIN_INTERVALS.get(host)
+	if not interval:
+		return
+	with _lock:
+		now = time.monotonic()
+		start = max(now, _next_request.get(host, now))
+		_next_request[host] = start + interval
+	if start > now:
+		time.sleep(start - now)
+
+
+def send(method: str, url: str, **kwargs: any) -> requests.Response:
+	kwargs.setdefault('timeout', TIMEOUT)
+	host = urlsplit(url).netloc
+	session = get_session(host)
+	_throttle(host)
+	return session.request(method, url, **kwargs)
+
+
+def decode(response: requests.Response) -> any:
+	# Parse the raw bytes, skipping the intermediate str of response.text
+	return json.loads(response.content)
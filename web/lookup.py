@@ -0,0 +1,51 @@
+# Standard library imports
+import threading
+
+# Local imports
+from flasktools.db import fetch_query
+
+# Process-wide scryfallid -> printing id index, shared by every import path
+_printings = {}
+_warmed = False
+_lock = threading.Lock()
+
+
+def warm() -> None:
+	global _warmed
+	with _lock:
+		if _warmed:
+			return
+		resp = fetch_query(
+			"SELECT id, scryfallid FROM printing WHERE scryfallid IS NOT NULL"
+		)
+		_printings.update({r['scryfallid']: r['id'] for r in resp})
+		_warmed = True
+
+
+def add(printings: dict) -> None:
+	with _lock:
+		_printings.update(printings)
+
+
+def resolve(scryfall_ids: list) -> dict:
+	warm()
+	found = {}
+	missing = []
+	for scryfallid in scryfall_ids:
+		printingid = _printings.get(scryfallid)
+		if printingid is None:
+			missing.append(scryfallid)
+		else:
+			found[scryfallid] = printingid
+
+	if missing:
+		# Catch printings inserted by other processes since warming
+		resp = fetch_query(
+			"SELECT id, scryfallid FROM printing WHERE scryfallid = ANY(%s)",
+			(list(set(missing)),)
+		)
+		inserted = {r['scryfallid']: r['id'] for r in resp}
+		add(inserted)
+		found.update(inserted)
+
+	return found
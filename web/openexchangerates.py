@@ -1,9 +1,5 @@
-# Standard library imports
-import requests
-import json
-
 # Local imports
-from web import config
+from web import httpclient, config
 
 
 class OpenExchangeRatesException(Exception):
@@ -12,10 +8,11 @@ class OpenExchangeRatesException(Exception):
 
 def get() -> dict:
 	params = {'app_id': config.OPENEXCHANGERATES_APPID, 'base': 'USD'}
-	response = requests.get(
+	response = httpclient.send(
+		'GET',
 		'https://openexchangerates.org/api/latest.json',
 		params=params
 	)
 	response.raise_for_status()
-	response = json.loads(response.text)
+	response = httpclient.decode(response)
 	return response['rates']
@@ -0,0 +1,264 @@
+# Standard library imports
+import hashlib
+import json
+
+# Local imports
+from web import records, functions, config
+from flasktools.db import fetch_query, mutate_query
+
+# Owned, valuable or volatile printings refresh daily, everything else every
+# BULK_DAYS, and a run makes at most BUDGET upstream pricing calls. Printings
+# whose last check found no price are always bulk.
+HIGH_VALUE = getattr(config, 'PRICE_REFRESH_HIGH_VALUE', 5)
+VOLATILITY = getattr(config, 'PRICE_REFRESH_VOLATILITY', 0.2)
+BULK_DAYS = getattr(config, 'PRICE_REFRESH_BULK_DAYS', 7)
+BUDGET = getattr(config, 'PRICE_REFRESH_BUDGET', 500)
+CHUNK_SIZE = getattr(config, 'PRICE_CHUNK_SIZE', 1000)
+
+# Computed history is cached until the next price ingest bumps the generation
+GENERATION_KEY = 'collector:prices:generation'
+HISTORY_KEY = 'collector:pricehistory:{}:{}:{}'
+HISTORY_TTL = 60 * 60 * 24
+
+
+def _query(
+	columns: str,
+	printingid: int = None,
+	missing_prices: bool = False,
+	scheduled: bool = False
+) -> tuple:
+	qry = """SELECT %s
+			FROM printing p
+			LEFT JOIN card_set s ON (s.id = p.card_setid)
+			LEFT JOIN card c ON (c.id = p.cardid)
+			CROSS JOIN LATERAL (
+				SELECT COALESCE(
+					p.price_updated >= p.price_checked, p.price_checked IS NULL
+				) AND (
+					EXISTS (SELECT 1 FROM user_card WHERE printingid = p.id)
+					OR GREATEST(p.price, p.foilprice)::NUMERIC >= %%s
+					OR EXISTS (
+						SELECT 1 FROM price_history ph
+						WHERE ph.printingid = p.id
+						AND ph.created >= current_date - 7
+						AND abs(ph.price::NUMERIC - p.price::NUMERIC)
+							> p.price::NUMERIC * %%s
+					)
+				) AS daily
+			) t
+			WHERE NOT is_basic_land(c.id)""" % columns
+	qargs = (HIGH_VALUE, VOLATILITY,)
+	if printingid is not None:
+		qry += " AND p.id = %s"
+		qargs += (printingid,)
+	if missing_prices:
+		qry += " AND COALESCE(p.price, p.foilprice) IS NULL"
+	if scheduled:
+		qry += """ AND (
+			GREATEST(p.price_updated, p.price_checked) IS NULL
+			OR GREATEST(p.price_updated, p.price_checked)
+				<= current_date - CASE WHEN t.daily THEN 1 ELSE %s END
+		)"""
+		qargs += (BULK_DAYS,)
+	return qry, qargs
+
+
+def get_printings(ids: list) -> list:
+	resp = fetch_query(
+		"""
+		SELECT p.id, p.collectornumber, c.name, p.rarity,
+			s.code AS set_code, s.name AS set_name, s.tcgplayer_groupid AS groupid,
+			p.tcgplayer_productid AS productid, p.language
+		FROM printing p
+		LEFT JOIN card_set s ON (s.id = p.card_setid)
+		LEFT JOIN card c ON (c.id = p.cardid)
+		WHERE p.id = ANY(%s)
+		""",
+		(ids,)
+	)
+	return [records.Printing(**c) for c in resp]
+
+
+def iter_due(
+	printingid: int = None,
+	missing_prices: bool = False,
+	scheduled: bool = False
+) -> any:
+	# The due set is computed in a single query, daily tier first and the
+	# most stale first within each tier, so the budget keeps the right rows
+	qry, qargs = _query(
+		"""p.id, s.tcgplayer_groupid AS groupid,
+		p.tcgplayer_productid AS productid""",
+		printingid=printingid,
+		missing_prices=missing_prices,
+		scheduled=scheduled
+	)
+	qry += """ ORDER BY
+		t.daily DESC,
+		GREATEST(p.price_updated, p.price_checked) NULLS FIRST,
+		p.id"""
+	for r in fetch_query(qry, qargs):
+		yield r
+
+
+def get_listing_pages() -> dict:
+	# Product listing requests resolve_products() makes per set, 100 a page
+	resp = fetch_query(
+		"""
+		SELECT s.tcgplayer_groupid AS groupid, CEIL(count(p.id) / 100.0) AS pages
+		FROM card_set s
+		JOIN printing p ON (p.card_setid = s.id)
+		WHERE s.tcgplayer_groupid IS NOT NULL
+		GROUP BY s.tcgplayer_groupid
+		"""
+	)
+	return {r['groupid']: int(r['pages']) for r in resp}
+
+
+def apply_budget(
+	rows: any,
+	group_mode: bool,
+	budget: int = BUDGET,
+	listing_pages: dict = None
+) -> any:
+	# Rows arrive in priority order, keep them while upstream calls remain.
+	# A group request prices every card in its set, so those come free, but
+	# a card without a product id first costs its set's product listing.
+	listing_pages = listing_pages or {}
+	listed = set()
+	groups = set()
+	products = 0
+	calls = 0
+	for r in rows:
+		groupid = r['groupid']
+		cost = 0
+		listing = r['productid'] is None and groupid and groupid not in listed
+		if listing:
+			cost += listing_pages.get(groupid, 1)
+		if group_mode and groupid:
+			if groupid not in groups:
+				cost += 1
+		elif r['productid'] is not None or groupid:
+			if products % 250 == 0:
+				cost += 1
+		else:
+			# Nothing upstream can price it, it's only marked as checked
+			yield r
+			continue
+
+		if cost and calls + cost > budget:
+			continue
+		calls += cost
+		if listing:
+			listed.add(groupid)
+		if group_mode and groupid:
+			groups.add(groupid)
+		else:
+			products += 1
+		yield r
+	print('Scheduled refresh within {} upstream calls.'.format(calls))
+
+
+def mark_checked(ids: list) -> None:
+	mutate_query(
+		"UPDATE printing SET price_checked = current_date WHERE id = ANY(%s)",
+		(ids,)
+	)
+
+
+def chunk_ids(rows: any, group_mode: bool, size: int = CHUNK_SIZE) -> any:
+	# In group mode a chunk never spans sets, so each costs one group request.
+	# Rows arrive in priority order rather than by set, so sets are gathered
+	# first, in the order they were first seen.
+	if group_mode:
+		groups = {}
+		for r in rows:
+			groups.setdefault(r['groupid'], []).append(r['id'])
+		for ids in groups.values():
+			yield from functions.batched(ids, size)
+		return
+
+	yield from functions.batched((r['id'] for r in rows), size)
+
+
+def bump_generation() -> None:
+	functions.get_redis().incr(GENERATION_KEY)
+
+
+def get_history(printingids: list, points: int) -> dict:
+	# Bucketed closing USD prices on an axis shared by all the printings,
+	# with compacted rollups filling in history older than the partitions
+	printingids = sorted({int(x) for x in printingids})
+	redis = functions.get_redis()
+	generation = int(redis.get(GENERATION_KEY) or 0)
+	key = HISTORY_KEY.format(
+		generation,
+		points,
+		hashlib.sha1(json.dumps(printingids).encode('utf-8')).hexdigest()
+	)
+	cached = redis.get(key)
+	if cached is not None:
+		return json.loads(cached)
+
+	rows = fetch_query(
+		"""
+		WITH series AS (
+			SELECT printingid, created, price, foilprice
+			FROM price_history
+			WHERE printingid = ANY(%s)
+			UNION ALL
+			SELECT printingid, period_start, price_close, foilprice_close
+			FROM price_history_rollup
+			WHERE printingid = ANY(%s)
+		), bounds AS (
+			SELECT
+				MIN(created) AS first,
+				GREATEST(
+					CEIL((MAX(created) - MIN(created) + 1) / %s::NUMERIC), 1
+				)::INTEGER AS size
+			FROM series
+		), bucketed AS (
+			SELECT s.*, b.first + (s.created - b.first) / b.size * b.size AS bucket
+			FROM series s, bounds b
+		)
+		SELECT
+			printingid, bucket, to_char(bucket, 'DD/MM/YY') AS label,
+			(
+				array_agg(price ORDER BY created DESC)
+				FILTER (WHERE price IS NOT NULL)
+			)[1]::NUMERIC AS price,
+			(
+				array_agg(foilprice ORDER BY created DESC)
+				FILTER (WHERE foilprice IS NOT NULL)
+			)[1]::NUMERIC AS foilprice
+		FROM bucketed
+		GROUP BY printingid, bucket
+		ORDER BY bucket
+		""",
+		(printingids, printingids, points,)
+	)
+
+	dates = []
+	for r in rows:
+		if not dates or dates[-1] != r['label']:
+			dates.append(r['label'])
+	positions = {label: i for i, label in enumerate(dates)}
+	history = {
+		'dates': dates,
+		'prices': {
+			str(printingid): {
+				'price': [None] * len(dates),
+				'foilprice': [None] * len(dates)
+			}
+			for printingid in printingids
+		}
+	}
+	for r in rows:
+		series = history['prices'][str(r['printingid'])]
+		series['price'][positions[r['label']]] = functions.make_float(r['price'])
+		series['foilprice'][positions[r['label']]] = functions.make_float(
+			r['foilprice']
+		)
+
+	redis.set(key, json.dumps(history), ex=HISTORY_TTL)
+	return history
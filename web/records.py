@@ -0,0 +1,36 @@
+# Standard library imports
+from typing import NamedTuple
+
+# Tuple-backed records for bulk card processing. They carry no per-instance
+# dict, and tuple(record) / Record._make(seq) convert to and from the
+# positional wire format sent through Celery.
+
+
+class Card(NamedTuple):
+	name: str
+	scryfallid: str
+	rarity: str
+	set: str
+	set_name: str
+	collectornumber: str
+	multifaced: bool
+	cmc: float
+	typeline: str
+	language: str
+	manacost: str = None
+	multiverseid: int = None
+	colors: str = None
+	imageurl: str = None
+	arturl: str = None
+
+
+class Printing(NamedTuple):
+	id: int
+	name: str
+	collectornumber: str
+	rarity: str
+	set_code: str
+	set_name: str
+	groupid: int = None
+	productid: str = None
+	language: str = 'en'
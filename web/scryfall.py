@@ -1,6 +1,25 @@
 # Standard library imports
 import requests
 import json
+import re
+import time
+
+# Local imports
+from web import httpclient, diskcache, catalogue, functions, records, config
+
+WORKERS = getattr(config, 'SCRYFALL_WORKERS', 4)
+
+# Scryfall search syntax: keywords, comparisons, quoting, grouping, negation
+# and exact "!" names
+SEARCH_SYNTAX = re.compile(r'[:=<>!"()]|(?:^|\s)-')
+
+# Seconds a cached GET is served without revalidation, by endpoint prefix.
+# Searches are never cached, they should see printings Scryfall just added.
+CACHE_TTLS = (
+	('/cards/search', None),
+	('/cards/', 60 * 60 * 24 * 7),
+	('/sets', 60 * 60 * 24 * 7),
+)
 
 
 class ScryfallException(Exception):
@@ -11,21 +30,46 @@ class NotFound(ScryfallException):
 	pass
 
 
+def _cache_ttl(endpoint: str) -> int:
+	for prefix, ttl in CACHE_TTLS:
+		if endpoint.startswith(prefix):
+			return ttl
+	return None
+
+
 def _send_request(
 	endpoint: str,
 	params: any = None,
 	data: any = None,
 	post: bool = False
 ) -> any:
-	func = requests.get
-	if post is True:
-		func = requests.post
-	response = func(
+	headers = {'Content-Type': 'application/json'}
+
+	ttl = None if post is True else _cache_ttl(endpoint)
+	entry = None
+	if ttl is not None:
+		cachekey = diskcache.key(endpoint, params)
+		entry = diskcache.load(cachekey)
+		if entry is not None:
+			if time.time() - entry['stored'] < ttl:
+				return entry['body']
+			if entry.get('etag'):
+				headers['If-None-Match'] = entry['etag']
+			if entry.get('last_modified'):
+				headers['If-Modified-Since'] = entry['last_modified']
+
+	response = httpclient.send(
+		'POST' if post is True else 'GET',
 		'https://api.scryfall.com{}'.format(endpoint),
 		params=params,
 		data=data,
-		headers={'Content-Type': 'application/json'}
+		headers=headers
 	)
+	if entry is not None and response.status_code == 304:
+		entry['stored'] = time.time()
+		diskcache.store(cachekey, entry)
+		return entry['body']
+
 	try:
 		response.raise_for_status()
 	except requests.HTTPError as e:
@@ -33,11 +77,26 @@ def _send_request(
 			raise NotFound from e
 		raise
 
-	resp = json.loads(response.text)
+	resp = httpclient.decode(response)
+	if ttl is not None:
+		diskcache.store(cachekey, {
+			'stored': time.time(),
+			'etag': response.headers.get('ETag'),
+			'last_modified': response.headers.get('Last-Modified'),
+			'body': resp
+		})
 	return resp
 
 
 def search(name: str) -> list:
+	# Plain card names are answered offline from the catalogue. Queries using
+	# Scryfall search syntax, or names the catalogue doesn't have yet, go to
+	# the live API.
+	if not SEARCH_SYNTAX.search(name):
+		simple_resp = catalogue.search(name)
+		if simple_resp:
+			return simple_resp
+
 	params = {'q': name, 'unique': 'prints'}
 	resp = _send_request('/cards/search', params=params)
 	simple_resp = []
@@ -55,68 +114,135 @@ def get_set(code: str) -> dict:
 	return resp
 
 
-def get(code: str, collectornumber: str) -> list:
+def get(code: str, collectornumber: str) -> records.Card:
+	card = catalogue.get(code, collectornumber)
+	if card is not None:
+		return card
 	resp = _send_request('/cards/{}/{}'.format(code.lower(), collectornumber))
 	return simplify(resp)
 
 
 def get_bulk(scryfall_ids: list) -> list:
+	simple_resp, scryfall_ids = catalogue.get_bulk(scryfall_ids)
+	if not scryfall_ids:
+		return simple_resp
+
+	# Ids Scryfall doesn't know are left out, callers work out what is missing
 	data = {'identifiers': [{'id': x} for x in scryfall_ids]}
 	resp = _send_request('/cards/collection', data=json.dumps(data), post=True)
-	simple_resp = []
 	if resp['not_found']:
-		raise ScryfallException('Not found: {}'.format(resp['not_found']))
+		print('Not found: {}'.format(resp['not_found']))
 	for r in resp['data']:
 		simple_resp.append(simplify(r))
 	return simple_resp
 
 
-def bulk_file_import(filename: str) -> list:
-	with open(filename) as f:
-		data = json.loads(f.read())
-	simple_resp = []
-	for r in data:
-		simple_resp.append(simplify(r))
-	return simple_resp
-
-
-def simplify(resp: dict) -> dict:
-	simple = {
-		'name': resp['name'],
-		'multiverseid': None,
-		'scryfallid': resp['id'],
-		'rarity': resp['rarity'].upper()[0],
-		'set': resp['set'].upper(),
-		'set_name': resp['set_name'],
-		'collectornumber': resp['collector_number'],
-		'multifaced': False,
-		'cmc': resp['cmc'],
-		'typeline': resp['type_line'],
-		'language': resp['lang'],
-		'manacost': resp.get('mana_cost')
-	}
-
+def download_bulk_file(
+	filename: str,
+	bulk_type: str = 'default_cards'
+) -> None:
+	resp = _send_request('/bulk-data/{}'.format(bulk_type))
+	response = httpclient.send('GET', resp['download_uri'], stream=True)
+	response.raise_for_status()
+	with open(filename, 'wb') as f:
+		for chunk in response.iter_content(chunk_size=1024 * 1024):
+			f.write(chunk)
+
+
+def _iter_json_array(f: any, chunk_size: int = 65536) -> any:
+	# Decode one element of a top-level JSON array at a time, so only the
+	# current chunk and element are ever held in memory
+	decoder = json.JSONDecoder()
+	buf = ''
+	pos = 0
+	started = False
+	eof = False
+	while True:
+		while pos < len(buf) and buf[pos] in ' \t\r\n,':
+			pos += 1
+		if pos < len(buf):
+			if not started:
+				if buf[pos] != '[':
+					raise ScryfallException('Bulk file is not a JSON array.')
+				started = True
+				pos += 1
+				continue
+			if buf[pos] == ']':
+				return
+			try:
+				obj, end = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError:
+				# Element is split across chunks, read more below
+				if eof:
+					raise
+			else:
+				# A number cut off by the chunk edge ("1." of "1.5") still
+				# decodes, so only accept an element once a delimiter follows
+				if eof or (end < len(buf) and buf[end] in ' \t\r\n,]'):
+					yield obj
+					pos = end
+					continue
+		if eof:
+			raise ScryfallException('Unexpected end of bulk file.')
+		chunk = f.read(chunk_size)
+		eof = not chunk
+		buf = buf[pos:] + chunk
+		pos = 0
+
+
+def iter_bulk(lots: any, workers: int = WORKERS) -> any:
+	# Fetches upcoming lots concurrently while the caller handles the current one
+	return functions.imap_bounded(get_bulk, lots, workers)
+
+
+def bulk_file_import(filename: str) -> any:
+	with open(filename, encoding='utf-8') as f:
+		for r in _iter_json_array(f):
+			yield simplify(r)
+
+
+def simplify(resp: dict) -> records.Card:
+	multiverseid = None
 	if resp['multiverse_ids']:
-		simple['multiverseid'] = resp['multiverse_ids'][0]
+		multiverseid = resp['multiverse_ids'][0]
 
 	# These should catch normal & split cards
+	colors = imageurl = arturl = None
 	if 'colors' in resp:
-		simple['colors'] = ''.join(resp['colors'])
+		colors = ''.join(resp['colors'])
 	if 'image_uris' in resp:
-		simple['imageurl'] = resp['image_uris']['normal']
-		simple['arturl'] = resp['image_uris']['art_crop']
+		imageurl = resp['image_uris']['normal']
+		arturl = resp['image_uris']['art_crop']
 
+	manacost = resp.get('mana_cost')
+	multifaced = False
 	if resp.get('card_faces'):
-		resp = resp['card_faces'][0]
-		simple['multifaced'] = True
+		face = resp['card_faces'][0]
+		multifaced = True
 
 		# These should catch double-sided cards
-		if 'colors' not in simple:
-			simple['colors'] = ''.join(resp['colors'])
-		if 'imageurl' not in simple:
-			simple['imageurl'] = resp['image_uris']['normal']
-			simple['arturl'] = resp['image_uris']['art_crop']
-		if simple['manacost'] is None:
-			simple['manacost'] = resp.get('mana_cost')
-
-	return simple
+		if colors is None:
+			colors = ''.join(face['colors'])
+		if imageurl is None:
+			imageurl = face['image_uris']['normal']
+			arturl = face['image_uris']['art_crop']
+		if manacost is None:
+			manacost = face.get('mana_cost')
+
+	return records.Card(
+		name=resp['name'],
+		scryfallid=resp['id'],
+		rarity=resp['rarity'].upper()[0],
+		set=resp['set'].upper(),
+		set_name=resp['set_name'],
+		collectornumber=resp['collector_number'],
+		multifaced=multifaced,
+		cmc=resp['cmc'],
+		typeline=resp['type_line'],
+		language=resp['lang'],
+		manacost=manacost,
+		multiverseid=multiverseid,
+		colors=colors,
+		imageurl=imageurl,
+		arturl=arturl
+	)
@@ -34,26 +34,40 @@ var search_req;
 var current_page = 1;
 var sort = 'name';
 var sort_desc = 'asc';
+// Cursors returned by the server for each page of the current query, so
+// paging forward (or back to a visited page) doesn't need an offset
+var page_cursors = {};
+var cursors_for;
 function get_collection() {
 	if (search_req) search_req.abort();
 	$('#collection_head').addClass('hide');
 	show_loading($('#collection_list'));
 	$('#collection_pagination, #collection_total').empty();
 
+	var params = {
+		'sort': sort,
+		'sort_desc': sort_desc,
+		'filter_search': $('#search').val(),
+		'filter_set': $('#filter_set_value').val(),
+		'filter_rarity': $('#filter_rarity_value').val()
+	};
+	var query = JSON.stringify(params);
+	if (query != cursors_for) {
+		page_cursors = {};
+		cursors_for = query;
+	}
+	params['page'] = current_page;
+	if (page_cursors[current_page]) params['cursor'] = page_cursors[current_page];
+
+	var requested_page = current_page;
 	search_req = $.ajax({
 		url: "/get_collection",
 		method: "GET",
-		data: {
-			'page': current_page,
-			'sort': sort,
-			'sort_desc': sort_desc,
-			'filter_search': $('#search').val(),
-			'filter_set': $('#filter_set_value').val(),
-			'filter_rarity': $('#filter_rarity_value').val()
-		}
+		data: params
 	}).done(function(data) {
 		if (data.error) M.toast({html: data.error});
 		else {
+			if (data.cursor) page_cursors[requested_page + 1] = data.cursor;
 			$('#collection_head').removeClass('hide');
 			compile_handlebars('collection-template', '#collection_list', data);
 
@@ -449,20 +463,50 @@ function bind_events() {
 
 		var upload_req = new XMLHttpRequest();
 		upload_req.open("POST", "/csv_upload", true);
+		upload_req.responseType = 'json';
 		upload_req.onload = function(oEvent) {
 			$('#upload_loading').empty();
-			if (upload_req.status == 200) {
+			var data = upload_req.response;
+			if (upload_req.status != 200) {
+				M.toast({html: "An internal error occurred. Please try again later."});
+			} else if (data.error) {
+				M.toast({html: data.error});
+			} else if (data.duplicate) {
 				M.Modal.getInstance($('#upload_modal')).close();
-				M.toast({html: "Successfully Uploaded"});
-				get_collection();
+				M.toast({html: "This file has already been imported."});
+			} else if (data.retried) {
+				M.Modal.getInstance($('#upload_modal')).close();
+				M.toast({html: "Retrying the cards that failed to import last time."});
+				poll_import(data.importid);
 			} else {
-				M.toast({html: "An internal error occurred. Please try again later."});
+				M.Modal.getInstance($('#upload_modal')).close();
+				M.toast({html: "Successfully Uploaded, importing in the background."});
+				poll_import(data.importid);
 			}
 		};
 
 		upload_req.send(formdata);
 	});
 
+	function poll_import(importid) {
+		$.ajax({
+			url: "/imports/" + importid + "/progress",
+			method: "GET"
+		}).done(function(data) {
+			if (data.error) M.toast({html: data.error});
+			else if (data.finished) {
+				if (data.failed) {
+					M.toast({html: "Imported " + data.done + " cards, " + data.failed + " could not be found. Upload the file again to retry them."});
+				} else {
+					M.toast({html: "Imported " + data.done + " cards."});
+				}
+				get_collection();
+			} else {
+				setTimeout(function() { poll_import(importid); }, 2000);
+			}
+		}).fail(ajax_failed);
+	}
+
 	$('#filter_btn').on('click', function() {
 		var filters = [];
 		$('#filter_modal select').each(function() {
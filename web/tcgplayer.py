@@ -1,9 +1,32 @@
 # Standard library imports
-import requests
 import json
+import re
+import time
 
 # Local imports
-from web import config
+from web import httpclient, records, functions, config
+
+
+# Refresh the bearer token this many seconds before it expires
+TOKEN_MARGIN = 60 * 60
+TOKEN_KEY = 'collector:tcgplayer:token'
+
+_token = None
+
+# Scryfall language codes to TCGplayer product condition languages
+LANGUAGES = {
+	'en': 'English',
+	'de': 'German',
+	'fr': 'French',
+	'it': 'Italian',
+	'es': 'Spanish',
+	'pt': 'Portuguese',
+	'ja': 'Japanese',
+	'ko': 'Korean',
+	'ru': 'Russian',
+	'zhs': 'Chinese (S)',
+	'zht': 'Chinese (T)'
+}
 
 
 class TCGPlayerException(Exception):
@@ -15,19 +38,34 @@ def _send_request(
 	params: any = None,
 	data: any = None,
 	headers: dict = None,
-	post: bool = False
+	post: bool = False,
+	auth: bool = True
 ) -> any:
-	func = requests.get
-	if post is True:
-		func = requests.post
-	response = func(
+	headers = dict(headers or {})
+	token = None
+	if auth is True:
+		token = get_token()
+		headers.update(_auth_header(token))
+
+	response = httpclient.send(
+		'POST' if post is True else 'GET',
 		'https://api.tcgplayer.com{}'.format(endpoint),
 		params=params,
 		data=data,
 		headers=headers
 	)
+	if token is not None and response.status_code == 401:
+		# Token revoked or expired early, refresh once and retry
+		headers.update(_auth_header(get_token(stale=token)))
+		response = httpclient.send(
+			'POST' if post is True else 'GET',
+			'https://api.tcgplayer.com{}'.format(endpoint),
+			params=params,
+			data=data,
+			headers=headers
+		)
 	response.raise_for_status()
-	resp = json.loads(response.text)
+	resp = httpclient.decode(response)
 	return resp
 
 
@@ -35,7 +73,7 @@ def _auth_header(token: str) -> str:
 	return {'Authorization': 'bearer {}'.format(token)}
 
 
-def login() -> str:
+def login() -> dict:
 	headers = {'Content-Type': 'application/x-www-form-urlencoded'}
 	data = {
 		'grant_type': 'client_credentials',
@@ -46,51 +84,76 @@ def login() -> str:
 		'/token',
 		data=data,
 		headers=headers,
-		post=True
+		post=True,
+		auth=False
 	)
 
-	return resp['access_token']
+	return resp
 
 
-def search_categories(token: str = None) -> str:
-	if token is None:
-		token = login()
-	headers = _auth_header(token)
-	resp = _send_request(
-		'/catalog/categories/1/search/manifest',
-		headers=headers
-	)
+def _cached_token(stale: str = None) -> str:
+	global _token
+	if _token is not None and _token[0] != stale and _token[1] > time.time():
+		return _token[0]
+	cached = functions.get_redis().get(TOKEN_KEY)
+	if cached is not None:
+		token, expires = json.loads(cached)
+		if token != stale:
+			_token = (token, expires)
+			return token
+	return None
+
+
+def get_token(stale: str = None) -> str:
+	# Token shared by web and Celery workers through Redis. Passing the token
+	# that was rejected forces a refresh unless another process already did.
+	global _token
+	token = _cached_token(stale)
+	if token is not None:
+		return token
+
+	redis = functions.get_redis()
+	with redis.lock(TOKEN_KEY + ':lock', timeout=60, blocking_timeout=60):
+		token = _cached_token(stale)
+		if token is not None:
+			return token
+
+		resp = login()
+		ttl = max(int(resp['expires_in']) - TOKEN_MARGIN, 1)
+		token = resp['access_token']
+		_token = (token, time.time() + ttl)
+		redis.set(TOKEN_KEY, json.dumps(_token), ex=ttl)
+	return token
+
+
+def search_categories() -> str:
+	resp = _send_request('/catalog/categories/1/search/manifest')
 	for r in resp['results'][0]['filters']:
 		if r['name'] == 'SetName':
 			for i in r['items']:
 				print(i)
 
 
-def search(card, token=None):
-	if token is None:
-		token = login()
-
+def search(card: records.Printing) -> str:
 	productid = None
 	# check for multiface card format
-	if ' // ' in card['name']:
-		card['name'] = card['name'].split(' // ')[0]
+	name = card.name.split(' // ')[0]
 
-	headers = _auth_header(token)
-	headers['Content-Type'] = 'application/json'
+	headers = {'Content-Type': 'application/json'}
 	data = {
 		'filters': [
 			{
 				'name': 'ProductName',
-				'values': [card['name']]
+				'values': [name]
 			},
 			{
 				'name': 'SetName',
-				'values': [card['set_name']]
+				'values': [card.set_name]
 			},
 			# Comment out rarity for fetching promos
 			{
 				'name': 'Rarity',
-				'values': [card['rarity']]
+				'values': [card.rarity]
 			}
 		]
 	}
@@ -110,8 +173,7 @@ def search(card, token=None):
 			'/catalog/products/{}'.format(
 				','.join([str(r) for r in search_results])
 			),
-			params={'getExtendedFields': True},
-			headers=headers
+			params={'getExtendedFields': True}
 		)
 		product_results = resp['results']
 		products_found = []
@@ -130,7 +192,7 @@ def search(card, token=None):
 				for ex in r['extendedData']:
 					if (
 						ex['name'] == 'Number'
-						and str(ex['value']) == str(card['collectornumber'])
+						and str(ex['value']) == str(card.collectornumber)
 					):
 						products_found.append(r)
 		if len(products_found) == 1:
@@ -138,24 +200,21 @@ def search(card, token=None):
 			print(
 				'Extra product search found result {} for {} {}'.format(
 					productid,
-					card['name'],
-					card['set_name']
+					name,
+					card.set_name
 				)
 			)
 		else:
 			# filter down from set details
 			group_params = ','.join([str(r['groupId']) for r in products_found])
-			resp = _send_request(
-				'/catalog/groups/{}'.format(group_params),
-				headers=headers
-			)
+			resp = _send_request('/catalog/groups/{}'.format(group_params))
 			group_results = resp['results']
 			groups_found = []
 			for r in group_results:
 				for p in products_found:
 					if (
 						str(r['groupId']) == str(p['groupId'])
-						and r['abbreviation'] == card['set_code']
+						and r['abbreviation'] == card.set_code
 					):
 						groups_found.append(p)
 			if len(groups_found) == 1:
@@ -163,60 +222,137 @@ def search(card, token=None):
 				print(
 					'Extra group search found result {} for {} {}'.format(
 						productid,
-						card['name'],
-						card['set_name']
+						name,
+						card.set_name
 					)
 				)
 		if productid is None:
 			print(
 				'MORE THAN ONE RESULT ({}) {} {} {}'.format(
 					len(search_results),
-					card['name'],
-					card['set_name'],
-					card['rarity']
+					name,
+					card.set_name,
+					card.rarity
 				)
 			)
 	else:
 		print(
 			'NO RESULT {} {} {}'.format(
-				card['name'],
-				card['set_name'],
-				card['rarity']
+				name,
+				card.set_name,
+				card.rarity
 			)
 		)
 	return productid
 
 
-def get_price(cards: list, token: str = None) -> dict:
-	if token is None:
-		token = login()
+def get_group_products(groupid: int) -> list:
+	products = []
+	while True:
+		resp = _send_request(
+			'/catalog/products',
+			params={
+				'categoryId': 1,
+				'groupId': groupid,
+				'getExtendedFields': True,
+				'offset': len(products),
+				'limit': 100
+			}
+		)
+		products.extend(resp['results'])
+		if not resp['results'] or len(products) >= resp['totalItems']:
+			return products
+
+
+def _product_key(name: str, number: any, language: str) -> tuple:
+	# Match on front face name without TCGplayer's "(Showcase)" style suffixes,
+	# and on collector number without any "/set size" or leading zeros
+	name = re.sub(r'\s*\(.*\)$', '', name.split(' // ')[0]).lower()
+	number = str(number).split('/')[0].lstrip('0').lower()
+	return (name, number, language)
+
+
+def resolve_group(groupid: int, cards: list) -> dict:
+	index = {}
+	for p in get_group_products(groupid):
+		number = None
+		for ex in p.get('extendedData', []):
+			if ex['name'] == 'Number':
+				number = ex['value']
+		languages = {pc['language'] for pc in p.get('productConditions', [])}
+		for language in languages or {'English'}:
+			key = _product_key(p['name'], number, language)
+			index.setdefault(key, set()).add(p['productId'])
+
+	productids = {}
+	for c in cards:
+		language = LANGUAGES.get(c.language, 'English')
+		found = index.get(_product_key(c.name, c.collectornumber, language), ())
+		if len(found) == 1:
+			productids[c.id] = next(iter(found))
+	print('Group {} matched {} of {} cards.'.format(
+		groupid, len(productids), len(cards)
+	))
+	return productids
+
+
+def resolve_products(cards: list, search_unmatched: bool = True) -> dict:
+	# One product listing per set instead of up to three requests per card
+	groups = {}
+	for c in cards:
+		groups.setdefault(c.groupid, []).append(c)
+
+	productids = {}
+	for groupid, group_cards in groups.items():
+		if groupid is not None:
+			productids.update(resolve_group(groupid, group_cards))
+
+	if search_unmatched:
+		for c in cards:
+			if c.id not in productids:
+				productid = search(c)
+				if productid is not None:
+					productids[c.id] = productid
+	return productids
+
+
+def get_price(cards: dict) -> dict:
 	print('Fetching prices for {} cards.'.format(len(cards)))
 	if len(cards) == 0:
 		print('Ignoring 0 length')
 		return {}
-	headers = _auth_header(token)
 	card_params = ','.join([cards[cardid] for cardid in cards])
-	resp = _send_request(
-		'/pricing/product/{}'.format(card_params),
-		headers=headers
-	)
+	resp = _send_request('/pricing/product/{}'.format(card_params))
+	return _match_prices(cards, resp['results'])
+
+
+def get_group_prices(groupid: int, cards: dict) -> dict:
+	print('Fetching group {} prices for {} cards.'.format(groupid, len(cards)))
+	resp = _send_request('/pricing/group/{}'.format(groupid))
+	return _match_prices(cards, resp['results'])
+
+
+def _match_prices(cards: dict, results: list) -> dict:
+	by_product = {}
+	for r in results:
+		by_product.setdefault(str(r['productId']), []).append(r)
+
 	prices = {
 		cardid: {'normal': None, 'foil': None, 'type': None}
 		for cardid, productid in cards.items()
 	}
 	for cardid, productid in cards.items():
-		for r in resp['results']:
-			if str(r['productId']) == productid:
-				# Fall back to market (recent sale) price if no mid (current sale) price
-				price_found = r['midPrice']
-				prices[cardid]['type'] = 'mid'
-				if price_found is None:
-					price_found = r['marketPrice']
-					prices[cardid]['type'] = 'market'
-				if r['subTypeName'] == 'Normal':
-					prices[cardid]['normal'] = price_found
-				elif r['subTypeName'] == 'Foil':
-					prices[cardid]['foil'] = price_found
-				else:
-					print('UNKNOWN SUBTYPE {} {}'.format(cards, r['subTypeName']))
+		for r in by_product.get(productid, []):
+			# Fall back to market (recent sale) price if no mid (current sale) price
+			price_found = r['midPrice']
+			prices[cardid]['type'] = 'mid'
+			if price_found is None:
+				price_found = r['marketPrice']
+				prices[cardid]['type'] = 'market'
+			if r['subTypeName'] == 'Normal':
+				prices[cardid]['normal'] = price_found
+			elif r['subTypeName'] == 'Foil':
+				prices[cardid]['foil'] = price_found
+			else:
+				print('UNKNOWN SUBTYPE {} {}'.format(productid, r['subTypeName']))
 	return prices